@@ -1,14 +1,23 @@
+import binascii
+import collections
+import concurrent.futures
 import contextlib
 import fcntl
+import functools
+import hashlib
 import io
 import logging
 import os
 import shutil
+import stat
 import subprocess
+import sys
 import tempfile
+import threading
 import traceback
 import transaction
 import weakref
+import zlib
 
 log = logging.getLogger(__name__)
 
@@ -41,7 +50,10 @@ class AcidFS(object):
 
        The name of a branch to use as the head for this transaction.  Changes
        made using this instance will be merged to the given head.  The default,
-       if omitted, is to use the repository's current head.
+       if omitted, is to use the repository's current head.  If the repository
+       has a detached HEAD, there is no current head to use, and a
+       `ValueError` is raised when the instance is first used in a transaction.
+       Pass the name of a branch in that case.
 
     ``create``
 
@@ -79,6 +91,7 @@ class AcidFS(object):
     """
 
     session = None
+    _catfile = None
     _cwd = ()
 
     def __init__(
@@ -106,13 +119,10 @@ class AcidFS(object):
                     dbpath = os.path.join(repo, ".git")
                 _check_output(args)
                 if user_name:
-                    args = ["git", "config", "user.name", user_name]
-                    _check_output(args, cwd=dbpath)
+                    _check_output(_git(dbpath, "config", "user.name", user_name))
                 if user_email:
-                    args = ["git", "config", "user.email", user_email]
-                    _check_output(args, cwd=dbpath)
-                args = ["git", "config", "core.quotepath", "false"]
-                _check_output(args, cwd=dbpath)
+                    _check_output(_git(dbpath, "config", "user.email", user_email))
+                _check_output(_git(dbpath, "config", "core.quotepath", "false"))
             else:
                 raise ValueError("No database found in %s" % dbpath)
 
@@ -121,24 +131,30 @@ class AcidFS(object):
         self.head = head
         self.name = name
         self.path_encoding = path_encoding
+        self._trees = collections.OrderedDict()
 
     def _session(self):
         """
         Make sure we're in a session.
         """
         if not self.session or self.session.closed:
+            # The cat-file process is kept running from one session to the
+            # next, unless it has been closed or has died in the meantime.
+            catfile = self._catfile
+            if catfile is None or catfile.closed:
+                catfile = self._catfile = _CatFile(self.db, self._trees)
+                weakref.finalize(self, catfile.close)
+            else:
+                catfile.poll()
             self.session = _Session(
-                self.wd, self.db, self.head, self.name, self.path_encoding
+                self.wd, self.db, self.head, self.name, self.path_encoding, catfile
             )
         return self.session
 
     def _mkpath(self, path):
-        if path == ".":
-            parsed = []
-        else:
-            parsed = list(filter(None, path.split("/")))
+        parsed = _parsepath(path)
         if not path.startswith("/"):
-            parsed = list(self._cwd) + parsed
+            parsed = self._cwd + parsed
         return parsed
 
     def get_base(self):
@@ -243,10 +259,10 @@ class AcidFS(object):
             exclusive = False
 
         if buffering < 0:
-            buffer_size = io.DEFAULT_BUFFER_SIZE
+            buffer_size = _STREAM_BUFFER_SIZE
             line_buffering = False
         elif buffering == 1:
-            buffer_size = io.DEFAULT_BUFFER_SIZE
+            buffer_size = _STREAM_BUFFER_SIZE
             line_buffering = True
         else:
             buffer_size = buffering
@@ -284,7 +300,7 @@ class AcidFS(object):
                 raise _FileExists(path)
             blob = obj.new_blob(name, prev)
             if append and prev:
-                shutil.copyfileobj(prev.open(), blob)
+                blob.copy(prev)
             if buffering:
                 blob = io.BufferedWriter(blob, buffer_size)
             if text:
@@ -467,53 +483,100 @@ class ConflictError(Exception):
 
 class _Session(object):
     closed = False
-    lockfd = None
+    lock = None
+    reffd = None
+    reflock = None
+    refdirs = ()
 
-    def __init__(self, wd, db, head, name, path_encoding):
+    def __init__(self, wd, db, head, name, path_encoding, catfile):
         self.wd = wd
         self.db = db
         self.name = name
         self.path_encoding = path_encoding
         self.lock_file = os.path.join(db, "acidfs.lock")
-        transaction.get().join(self)
+        self.catfile = catfile
 
-        curhead = open(os.path.join(db, "HEAD")).read().strip()[16:]
+        curhead = os.fsdecode(_read_small(os.path.join(db, "HEAD")))
+        if curhead.startswith("ref: refs/heads/"):
+            curhead = curhead[16:]
+        else:
+            # Detached HEAD
+            curhead = None
         if head == curhead:
             head = "HEAD"
         if head == "HEAD":
-            self.headref = os.path.join(db, "refs", "heads", curhead)
+            if curhead is None:
+                raise ValueError(
+                    "Cannot use HEAD of repository with detached HEAD. Pass "
+                    "the name of a branch as `head` instead."
+                )
+            self.headref = "refs/heads/" + curhead
         else:
-            self.headref = os.path.join(db, "refs", "heads", head)
+            self.headref = "refs/heads/" + head
         self.head = head
 
-        if os.path.exists(self.headref):
-            # Existing head, get head revision
-            self.prev_commit = _check_output(
-                ["git", "rev-list", "--max-count=1", head], cwd=db
-            ).strip()
-            tree = _check_output(
-                [
-                    "git",
-                    "rev-parse",
-                    f"{self.prev_commit.decode('ascii')}^{{tree}}",
-                ],
-                cwd=self.db,
-            ).strip()
-            self.tree = _TreeNode.read(db, tree, path_encoding)
+        self.prev_commit, tree = self.read_head()
+        if self.prev_commit:
+            # Existing head
+            self.tree = _TreeNode.read(db, self.catfile, tree, path_encoding)
         else:
             # New head, no commits yet
-            self.tree = _TreeNode(db, path_encoding)  # empty tree
-            self.prev_commit = None
+            self.tree = _TreeNode(db, self.catfile, path_encoding)  # empty tree
+
+        transaction.get().join(self)
+
+    def read_head(self):
+        """
+        Returns the ids of the commit at the tip of our head and of its tree,
+        or `(None, None)` if the head has no commits yet.
+        """
+        # Usually the ref is a file holding the commit id, and the commit can be
+        # read through the cat-file process, so no new process is needed.
+        try:
+            commit = _read_small(os.path.join(self.db, self.headref))
+        except OSError:
+            commit = None
+        if commit and not commit.startswith(b"ref:"):
+            data = self.catfile.read("commit", commit)
+            return commit, data[5 : data.index(b"\n")]  # "tree <id>"
+
+        # Otherwise ask git, since the ref may have been packed.
+        headref = os.fsencode(self.headref)
+        output = _check_output(
+            _git(
+                self.db,
+                "for-each-ref",
+                "--format=%(refname) %(objectname) %(tree)",
+                self.headref,
+            )
+        )
+        # for-each-ref also matches refs below ours, eg. refs/heads/a/b for a
+        for line in output.splitlines():
+            refname, commit, tree = line.split()
+            if refname == headref:
+                return commit, tree
+        return None, None
+
+    def resolve(self, ref):
+        """
+        Returns the ids of the commit `ref` refers to and of that commit's
+        tree, asking a single git process for both.
+        """
+        if isinstance(ref, bytes):
+            ref = ref.decode("ascii")
+        output = _check_output(
+            _git(self.db, "rev-parse", ref + "^{commit}", ref + "^{tree}")
+        )
+        commit, tree = output.split()
+        return commit, tree
 
     def set_base(self, ref):
         if self.tree.dirty:
             raise ConflictError(
                 "Cannot set base when changes already made in transaction."
             )
-        self.prev_commit = _check_output(
-            ["git", "rev-list", "--max-count=1", ref], cwd=self.db
-        ).strip()
-        self.tree = _TreeNode.read(self.db, self.prev_commit, self.path_encoding)
+        self.prev_commit, tree = self.resolve(ref)
+        self.tree = _TreeNode.read(self.db, self.catfile, tree, self.path_encoding)
 
     def find(self, path):
         assert isinstance(path, (list, tuple))
@@ -558,31 +621,30 @@ class _Session(object):
 
         # Acquire an exclusive (aka write) lock for merge.
         self.acquire_lock()
-
-        # If this is initial commit, there's not really anything to merge
-        if not self.prev_commit:
-            # Make sure there haven't been other commits
-            if os.path.exists(self.headref):
-                # This was to be the initial commit, but somebody got to it
-                # first No idea how to try to resolve that one.  Luckily it
-                # will be very rare.
-                raise ConflictError()
-
-            # New commit is new head
+        if self.head != "HEAD":
+            self.lock_ref()
+        current = self.read_head()[0]
+
+        # If nobody has moved our head since the transaction began, or the head
+        # doesn't exist yet, there's nothing to merge and we can just fast
+        # forward to the new commit.  This is the most common case.
+        if current == self.prev_commit or not current:
             self.next_commit = commit_oid
             return
 
+        # If this was to be the initial commit, but somebody got to it first,
+        # there's no idea how to try to resolve that one.  Luckily it will be
+        # very rare.
+        if not self.prev_commit:
+            raise ConflictError()
+
         # Find the merge base
-        current = _check_output(
-            ["git", "rev-list", "--max-count=1", "HEAD"], cwd=self.db
-        ).strip()
         merge_base = _check_output(
-            ["git", "merge-base", current, commit_oid], cwd=self.db
+            _git(self.db, "merge-base", current, commit_oid)
         ).strip()
 
-        # If the merge base is the current commit, it means there have been no
-        # intervening changes and we can just fast forward to the new commit.
-        # This is the most common case.
+        # If the merge base is the current commit, our base was set to a commit
+        # that has the head in its history, and we can still fast forward.
         if merge_base == current:
             self.next_commit = commit_oid
             return
@@ -599,29 +661,40 @@ class _Session(object):
         """
         if not self.tree.dirty:
             # Nothing to do
+            self.close()
             return
 
-        # Make our commit the new head
-        if self.head == "HEAD":
-            # Use git reset to update current head
-            args = ["git", "reset", self.next_commit]
-            if self.wd:
-                args.append("--hard")
-                cwd = self.wd
-            else:
-                args.append("--soft")
-                cwd = self.db
-            _check_output(args, cwd=cwd)
-
-        else:
-            # If not updating current head, just write the commit to the ref
-            # file directly.
-            reffile = os.path.join(self.db, "refs", "heads", self.head)
-            with open(reffile, "wb") as f:
-                f.write(self.next_commit)
-                f.write(b"\n")
+        # Make our commit the new head.  Whatever happens, the session is
+        # done, so its locks mustn't outlive it.
+        try:
+            if self.head == "HEAD":
+                # Use git reset to update current head
+                if self.wd:
+                    args = _git(self.db, "--work-tree", self.wd, "reset", "--hard")
+                else:
+                    args = _git(self.db, "reset", "--soft")
+                args.append(self.next_commit)
+                _check_output(args)
 
-        self.close()
+            else:
+                # If not updating current head, just write the commit to the
+                # lock file taken in tpc_vote and move it into place, as git
+                # would.
+                fd = self.reffd
+                self.reffd = None
+                try:
+                    os.write(fd, self.next_commit + b"\n")
+                finally:
+                    os.close(fd)
+                os.replace(self.reflock, os.path.join(self.db, self.headref))
+
+                # The lock file is now the ref, and the folders made for it
+                # hold the ref, so there's nothing left to clean up.
+                self.reflock = None
+                self.refdirs = ()
+
+        finally:
+            self.close()
 
     def tpc_abort(self, tx):
         """
@@ -634,19 +707,97 @@ class _Session(object):
 
     def close(self):
         self.closed = True
+        self.unlock_ref()
         self.release_lock()
 
-    def acquire_lock(self):
-        assert not self.lockfd
-        self.lockfd = fd = os.open(self.lock_file, os.O_WRONLY | os.O_CREAT)
-        fcntl.lockf(fd, fcntl.LOCK_EX)
+    def lock_ref(self):
+        """
+        Takes git's own lock on our head's ref, so that nothing else moves it
+        between our checking it and our updating it.
+        """
+        conflict = self.ref_conflict()
+        if conflict:
+            raise ConflictError(
+                "Cannot update %s, since %s exists." % (self.headref, conflict)
+            )
 
-    def release_lock(self):
-        fd = self.lockfd
+        # Remember the folders made for a new ref, so they can be removed
+        # again if the ref doesn't get written after all.
+        lockfile = os.path.join(self.db, self.headref) + ".lock"
+        folder = os.path.dirname(lockfile)
+        refdirs = []
+        while not os.path.isdir(folder):
+            refdirs.append(folder)
+            folder = os.path.dirname(folder)
+        os.makedirs(os.path.dirname(lockfile), exist_ok=True)
+        self.refdirs = refdirs
+
+        try:
+            self.reffd = os.open(lockfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            raise ConflictError("%s is being updated elsewhere." % self.headref)
+        self.reflock = lockfile
+
+    def unlock_ref(self):
+        """
+        Gives up our lock on our head's ref, if we still hold it, along with
+        any folders made for the ref that nothing else has used since.
+        """
+        fd = self.reffd
         if fd is not None:
-            fcntl.lockf(fd, fcntl.LOCK_UN)
+            self.reffd = None
             os.close(fd)
-            self.lockfd = None
+        lockfile = self.reflock
+        if lockfile is not None:
+            self.reflock = None
+            os.remove(lockfile)
+        for folder in self.refdirs:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+        self.refdirs = ()
+
+    def ref_conflict(self):
+        """
+        Returns the name of an existing ref that our head can't exist
+        alongside, if there is one.  Loose refs are files named after the ref,
+        so, as in git, there can't be both a `refs/heads/a` and a
+        `refs/heads/a/b`.
+        """
+        headref = self.headref
+        parts = headref.split("/")
+        parents = ["/".join(parts[:i]) for i in range(3, len(parts))]
+        for parent in parents:
+            if os.path.isfile(os.path.join(self.db, parent)):
+                return parent
+        if os.path.isdir(os.path.join(self.db, headref)):
+            return headref + "/..."
+
+        try:
+            with open(os.path.join(self.db, "packed-refs"), "rb") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+        prefix = headref + "/"
+        for line in lines:
+            if line.startswith((b"#", b"^")):
+                continue
+            refname = os.fsdecode(line.split(b" ", 1)[1])
+            if refname in parents or refname.startswith(prefix):
+                return refname
+        return None
+
+    def acquire_lock(self):
+        assert not self.lock
+        self.lock = lock = _FileLock.get(self.lock_file)
+        lock.acquire()
+
+    def release_lock(self):
+        lock = self.lock
+        if lock is not None:
+            self.lock = None
+            lock.release()
 
     def mkcommit(self, tx, tree_oid, parents, message=None):
         # Prepare metadata for commit
@@ -654,7 +805,7 @@ class _Session(object):
             message = tx.description
         if not message:
             message = "AcidFS transaction"
-        gitenv = os.environ.copy()
+        gitenv = {}
         extension = tx._extension  # "Official" API despite underscore
         user = extension.get("acidfs_user")
         if not user:
@@ -683,11 +834,15 @@ class _Session(object):
             ] = email
 
         # Write commit to db
-        args = ["git", "commit-tree", tree_oid, "-m", message]
+        args = _git(self.db, "commit-tree", tree_oid, "-m", message)
         for parent in parents:
             args.append("-p")
             args.append(parent)
-        return _check_output(args, cwd=self.db, env=gitenv).strip()
+        if gitenv:
+            gitenv = dict(os.environ, **gitenv)
+        else:
+            gitenv = None  # Just inherit our environment
+        return _check_output(args, env=gitenv).strip()
 
     def merge(self, base_oid, current, tree_oid):
         """
@@ -741,8 +896,7 @@ class _Session(object):
         'pragma NO COVER' and are easily recognized.
         """
         with _popen(
-            ["git", "merge-tree", base_oid, tree_oid, current],
-            cwd=self.db,
+            _git(self.db, "merge-tree", base_oid, tree_oid, current),
             stdout=subprocess.PIPE,
         ) as proc:
             # Messy finite state machine
@@ -811,7 +965,7 @@ class _Session(object):
                         parsed = path.decode("ascii").split("/")
                         folder = self.find(parsed[:-1])
                         expect(isinstance(folder, _TreeNode), "Not a folder: %s", path)
-                        folder.set(parsed[-1], (b"blob", oid, None))
+                        folder.set(parsed[-1], (b"blob", oid, None, mode))
                         state = extra_state = None
                         continue
 
@@ -873,7 +1027,8 @@ class _Session(object):
                         blob = folder.get(name)
                         expect(isinstance(blob, _Blob), "Not a blob")
                         with _tempfile() as tmp:
-                            shutil.copyfileobj(blob.open(), open(tmp, "wb"))
+                            with blob.open() as src, open(tmp, "wb") as dst:
+                                shutil.copyfileobj(src, dst, _BLOB_BUFFER_SIZE)
                             with _popen(
                                 ["patch", "-s", tmp, "-"],
                                 stdin=subprocess.PIPE,
@@ -887,7 +1042,8 @@ class _Session(object):
                                     f.write(line)
                                     line = stream.readline()
                             newblob = folder.new_blob(name, blob)
-                            shutil.copyfileobj(open(tmp, "rb"), newblob)
+                            with open(tmp, "rb") as src:
+                                shutil.copyfileobj(src, newblob, _BLOB_BUFFER_SIZE)
 
                         state = extra_state = None
                         continue
@@ -941,60 +1097,108 @@ class _TreeNode(object):
     committed_oid = None
 
     @classmethod
-    def read(cls, db, oid, path_encoding):
-        node = cls(db, path_encoding)
+    def read(cls, db, catfile, oid, path_encoding):
+        """
+        Returns a node for an existing tree.  Its contents aren't listed until
+        they are actually needed, so walking down to one deep file only reads
+        the trees along the way.
+        """
+        node = cls(db, catfile, path_encoding)
         node.committed_oid = node.oid = oid
-        contents = node.contents
-        with _popen(["git", "ls-tree", oid], stdout=subprocess.PIPE, cwd=db) as lstree:
-            for line in lstree.stdout.readlines():
-                mode, type, oid, name = _parsetree(line)
-                name = name.decode(path_encoding)
-                contents[name] = (type, oid, None)
-
+        node._contents = None
         return node
 
-    def __init__(self, db, path_encoding):
+    def __init__(self, db, catfile, path_encoding):
         self.db = db
+        self.catfile = catfile
         self.path_encoding = path_encoding
-        self.contents = {}
+        self._contents = {}
+
+    @property
+    def contents(self):
+        contents = self._contents
+        if contents is None:
+            contents = self._contents = self._read()
+        return contents
+
+    def _read(self):
+        # Trees are immutable, so contents parsed by an earlier session can be
+        # reused as is.  Each node gets its own copy to change, though.
+        oid = self.committed_oid
+        trees = self.catfile.trees
+        contents = trees.get(oid)
+        if contents is not None:
+            trees.move_to_end(oid)
+            return dict(contents)
+
+        # Parse the raw tree object, a run of "<mode> <name>\0<20 byte id>"
+        # entries, rather than having ls-tree format it for us.
+        contents = {}
+        data = self.catfile.read("tree", oid)
+        path_encoding = self.path_encoding
+        hexlify = binascii.hexlify
+        i = 0
+        end = len(data)
+        while i < end:
+            j = data.index(b"\0", i)
+            mode, name = data[i:j].split(b" ", 1)
+            i = j + 21
+            oid = hexlify(data[j + 1 : i])
+            if mode == b"40000":
+                type = b"tree"
+            elif mode == b"160000":
+                type = b"commit"
+            else:
+                type = b"blob"
+            contents[name.decode(path_encoding)] = (type, oid, None, mode)
+
+        trees[self.committed_oid] = contents
+        if len(trees) > _TREE_CACHE_SIZE:
+            trees.popitem(last=False)
+        return dict(contents)
 
     def get(self, name):
         contents = self.contents
         obj = contents.get(name)
         if not obj:
             return None
-        type, oid, obj = obj
+        type, oid, obj, mode = obj
         assert type in (b"tree", b"blob")
         if not obj:
             if type == b"tree":
-                obj = _TreeNode.read(self.db, oid, self.path_encoding)
+                obj = _TreeNode.read(self.db, self.catfile, oid, self.path_encoding)
             else:
-                obj = _Blob(self.db, oid)
+                obj = _Blob(self.catfile, oid)
             obj.parent = self
             obj.name = name
-            contents[name] = (type, oid, obj)
+            contents[name] = (type, oid, obj, mode)
         return obj
 
     def find(self, path):
-        if not path:
-            return self
-        obj = self.get(path[0])
-        if obj:
-            return obj.find(path[1:])
+        # Walk down a level at a time, rather than recursing with ever shorter
+        # slices of the path.
+        obj = self
+        for name in path:
+            if not isinstance(obj, _TreeNode):
+                return None
+            obj = obj.get(name)
+            if not obj:
+                return None
+        return obj
 
     def new_blob(self, name, prev):
         obj = _NewBlob(self.db, prev)
         obj.parent = self
         obj.name = name
-        self.contents[name] = (b"blob", None, weakref.proxy(obj))
+        self.contents[name] = (b"blob", None, weakref.proxy(obj), None)
         self.set_dirty()
         return obj
 
     def new_tree(self, name):
-        node = _TreeNode(self.db, self.path_encoding)
+        node = _TreeNode(self.db, self.catfile, self.path_encoding)
         node.parent = self
         node.name = name
-        self.contents[name] = (b"tree", None, node)
+        self.contents[name] = (b"tree", None, node, None)
         self.set_dirty()
         return node
 
@@ -1009,42 +1213,87 @@ class _TreeNode(object):
 
     def set_dirty(self):
         node = self
-        while node and not node.dirty:
+        while node and (node.oid or not node.dirty):
+            # A dirty node may still have a stale oid if it was hashed since
+            # it was last changed.
             node.oid = None
             node.dirty = True
             node = node.parent
 
     def save(self):
-        # Recursively save children, first
-        for name, (type, oid, obj) in list(self.contents.items()):
+        # Find every tree that needs to be written, grouped by depth, so that
+        # working from the deepest level up, a tree's subtrees always have ids
+        # by the time we get to it.
+        levels = []
+        level = [(None, None, self)]
+        while level:
+            levels.append(level)
+            level = [
+                (node, name, obj)
+                for _, _, node in level
+                for name, obj in node._unsaved_trees()
+            ]
+
+        # Each tree's id is worked out from its contents, so it can be written
+        # straight into the database without asking git to do it.
+        oids = []
+        trees = []
+        for level in reversed(levels):
+            for parent, name, node in level:
+                data = node._mktree()
+                if data is not None:
+                    oids.append(node.oid)
+                    trees.append(data)
+                if parent is not None:
+                    parent.contents[name] = (b"tree", node.oid, None, None)
+
+        # Nothing can reach the new trees until the head is moved to a commit
+        # of them, so they can be stored in any order, several at a time.
+        # Storing one is mostly waiting on the filesystem.
+        write = functools.partial(_write_object, self.db, b"tree")
+        if len(trees) > 1:
+            list(_get_save_pool().map(write, trees, oids))
+        else:
+            list(map(write, trees, oids))
+
+        return self.oid
+
+    def _unsaved_trees(self):
+        for name, (type, oid, obj, mode) in self.contents.items():
             if not obj:
                 continue  # Nothing to do
             if isinstance(obj, _NewBlob):
                 raise ValueError("Cannot commit transaction with open files.")
             elif type == b"tree" and (obj.dirty or not oid):
-                new_oid = obj.save()
-                self.contents[name] = (b"tree", new_oid, None)
+                yield name, obj
+
+    def _mktree(self):
+        # Serialize the tree object ourselves, in git's canonical format, to
+        # work out its id.  Entries are sorted by name, with the names of
+        # subtrees sorting as though they ended in a slash.
+        path_encoding = self.path_encoding
+        entries = []
+        for name, (type, oid, obj, mode) in self.contents.items():
+            name = name.encode(path_encoding)
+            if type == b"tree":
+                entries.append((name + b"/", b"40000 " + name, oid))
+            else:
+                # Entries read from the database keep their modes, so
+                # executables, symlinks and submodules stay what they were.
+                # New files are regular files.
+                entries.append((name, (mode or b"100644") + b" " + name, oid))
+        entries.sort()
+        data = b"".join(
+            [entry + b"\0" + binascii.unhexlify(oid) for _, entry, oid in entries]
+        )
+        self.oid = oid = _hash_object(b"tree", data)
 
-        # Save tree object out to database
-        with _popen(
-            ["git", "mktree"],
-            cwd=self.db,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-        ) as proc:
-            for name, (type, oid, obj) in self.contents.items():
-                proc.stdin.write(b"100644" if type == b"blob" else b"040000")
-                proc.stdin.write(b" ")
-                proc.stdin.write(type)
-                proc.stdin.write(b" ")
-                proc.stdin.write(oid)
-                proc.stdin.write(b"\t")
-                proc.stdin.write(name.encode(self.path_encoding))
-                proc.stdin.write(b"\n")
-            proc.stdin.close()
-            oid = proc.stdout.read().strip()
-        self.oid = oid
-        return oid
+        # If this is the tree we started from, it's already in the database.
+        # This spares writing it again when changes in a transaction cancel
+        # each other out.
+        if oid == self.committed_oid:
+            return None
+        return data
 
     def empty(self):
         return not self.contents
@@ -1058,21 +1307,24 @@ class _TreeNode(object):
         return self.oid
 
 
+@functools.lru_cache(maxsize=4096)
+def _parsepath(path):
+    if path == ".":
+        return ()
+    return tuple(sys.intern(name) for name in path.split("/") if name)
+
+
 def _parsetree(line):
     return line.strip().split(None, 3)
 
 
 class _Blob(object):
-    def __init__(self, db, oid):
-        self.db = db
+    def __init__(self, catfile, oid):
+        self.catfile = catfile
         self.oid = oid
 
     def open(self):
-        return _BlobStream(self.db, self.oid)
-
-    def find(self, path):
-        if not path:
-            return self
+        return self.catfile.open(self.oid)
 
     def hash(self):
         return self.oid
@@ -1083,27 +1335,30 @@ class _NewBlob(io.RawIOBase):
         self.db = db
         self.prev = prev
 
-        self.proc = subprocess.Popen(
-            ["git", "hash-object", "-w", "--stdin"],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            cwd=db,
-        )
+        # The header of a git object starts with the object's size, so the
+        # whole blob has to be in hand before it can be hashed and stored.
+        # `git hash-object --stdin` would hold it in memory too.
+        self.buffer = io.BytesIO()
 
     def write(self, b):
-        self.proc.stdin.write(b)
-        return len(b)
+        return self.buffer.write(b)
+
+    def copy(self, blob):
+        """
+        Copy the contents of an existing blob into this one.
+        """
+        with blob.open() as src:
+            shutil.copyfileobj(src, self.buffer, _BLOB_BUFFER_SIZE)
 
     def close(self):
+        if self.closed:
+            return
         super(_NewBlob, self).close()
-        self.proc.stdin.close()
-        oid = self.proc.stdout.read().strip()
-        self.proc.stdout.close()
-        retcode = self.proc.wait()
-        if retcode != 0:
-            raise subprocess.CalledProcessError(retcode, "git hash-object -w --stdin")
-        self.parent.contents[self.name] = (b"blob", oid, None)
+        data = self.buffer.getvalue()
+        self.buffer.close()
+        oid = _hash_object(b"blob", data)
+        _write_object(self.db, b"blob", data, oid)
+        self.parent.contents[self.name] = (b"blob", oid, None, None)
 
     def writable(self):
         return True
@@ -1118,18 +1373,14 @@ class _NewBlob(io.RawIOBase):
             return self.prev.hash()
         raise _NoSuchFileOrDirectory(_object_path(self))
 
-    def find(self, path):
-        if not path:
-            return self
-
 
 class _BlobStream(io.RawIOBase):
     def __init__(self, db, oid):
         self.proc = subprocess.Popen(
-            ["git", "cat-file", "blob", oid],
+            _git(db, "cat-file", "blob", oid),
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            cwd=db,
+            bufsize=0,
         )
         self.oid = oid
 
@@ -1163,22 +1414,360 @@ class _BlobStream(io.RawIOBase):
             )
 
 
+class _CatFile(object):
+    """
+    A long running `git cat-file --batch` process, through which a session
+    reads its trees and blobs without starting a new git process for each
+    one.  The process can only stream one object at a time, so while a blob is
+    being read from it, other objects are read by running git just for them.
+
+    The process belongs to the `AcidFS` instance and is handed from one
+    session to the next, so a new transaction doesn't have to start it again.
+    `trees` holds the parsed contents of recently read trees, keyed by id.
+    """
+
+    proc = None
+    stream = None
+    closed = False
+
+    def __init__(self, db, trees):
+        self.db = db
+        self.trees = trees
+
+    def read(self, type, oid):
+        """
+        Returns the whole contents of a small object, such as a tree.
+        """
+        if self.stream is not None or self.closed:
+            return _check_output(_git(self.db, "cat-file", type, oid))
+
+        size = self._request(oid)
+        data = self.proc.stdout.read(size + 1)
+        if len(data) != size + 1:
+            self.stop()
+            raise subprocess.CalledProcessError(
+                1, "git cat-file --batch", "Unexpected end of object %s" % oid
+            )
+        return data[:-1]
+
+    def open(self, oid):
+        if self.stream is not None or self.closed:
+            return _BlobStream(self.db, oid)
+
+        # Only a weak reference, so a stream that's dropped without being
+        # closed is still finalized, and closed, and lets go of the process.
+        stream = _BatchBlobStream(self, oid, self._request(oid))
+        self.stream = weakref.ref(stream)
+        return stream
+
+    def _request(self, oid):
+        """
+        Asks the batch process for an object and returns the object's size.
+        Its contents follow on the process's stdout.
+        """
+        proc = self.proc
+        if proc is None:
+            proc = self.proc = subprocess.Popen(
+                _git(self.db, "cat-file", "--batch"),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                bufsize=_BLOB_BUFFER_SIZE,
+            )
+        try:
+            proc.stdin.write(oid + b"\n")
+            proc.stdin.flush()
+        except OSError:
+            # Git has gone away
+            self.stop()
+            raise subprocess.CalledProcessError(
+                1, "git cat-file --batch", "Unable to request object %s" % oid
+            )
+        header = proc.stdout.readline().split()
+        if len(header) != 3:
+            # Missing object, or git has gone away
+            self.stop()
+            raise subprocess.CalledProcessError(
+                1, "git cat-file --batch", b" ".join(header)
+            )
+        return int(header[2])
+
+    def done(self, stream):
+        """
+        Called by a stream when it is closed, to ready the process for the next
+        object.  If much of the blob is left unread, it's cheaper to let this
+        process go and start another than to read the rest of it.
+        """
+        self.stream = None
+        proc = self.proc
+        if proc is None:
+            # Already let go of, after an error
+            return
+        if self.closed or stream.remaining > _BLOB_BUFFER_SIZE:
+            self.stop()
+            return
+
+        # Skip the rest of the blob and the newline that follows it.  If git
+        # goes away before sending them, the process is no good any more.
+        skip = stream.remaining + 1
+        if len(proc.stdout.read(skip)) != skip:
+            self.stop()
+
+    def poll(self):
+        """
+        Lets go of the process if it has exited since it was last used, so a
+        new one is started for the next object.
+        """
+        proc = self.proc
+        if proc is not None and proc.poll() is not None:
+            self.stop()
+
+    def close(self):
+        self.closed = True
+        if self.stream is None:
+            self.stop()
+
+    def stop(self):
+        proc = self.proc
+        if proc is not None:
+            self.proc = None
+            try:
+                proc.stdin.close()
+            except OSError:
+                # A request was still waiting to be sent to a git that's gone
+                pass
+            proc.stdout.close()
+            proc.wait()
+
+
+class _BatchBlobStream(io.RawIOBase):
+    def __init__(self, catfile, oid, size):
+        self.catfile = catfile
+        self.oid = oid
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.remaining)
+        if not n:
+            return 0
+        proc = self.catfile.proc
+        if proc is not None:
+            n = proc.stdout.readinto(memoryview(b)[:n])
+        else:
+            # The process was let go of after an error
+            n = 0
+        if not n:
+            self.catfile.stop()
+            raise subprocess.CalledProcessError(
+                1, "git cat-file --batch", "Unexpected end of blob %s" % self.oid
+            )
+        self.remaining -= n
+        return n
+
+    def close(self):
+        if not self.closed:
+            super(_BatchBlobStream, self).close()
+            self.catfile.done(self)
+
+
+class _FileLock(object):
+    """
+    An exclusive lock on a repository's lock file, shared by every session in
+    this process.  A lock on a file belongs to the whole process, so on its own
+    it wouldn't keep out other threads, and closing any descriptor for the file
+    would let go of it.  Threads take turns on an ordinary lock instead, and
+    only the outermost holder, counting sessions in the same thread that commit
+    to the same repository, actually locks the file.
+    """
+
+    count = 0
+    fd = None
+
+    @classmethod
+    def get(cls, path):
+        path = os.path.realpath(path)
+        lock = _file_locks.get(path)
+        if lock is None:
+            lock = _file_locks.setdefault(path, cls(path))
+        return lock
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+
+    def acquire(self):
+        self.lock.acquire()
+        if not self.count:
+            self.fd = fd = os.open(self.path, os.O_WRONLY | os.O_CREAT)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+        self.count += 1
+
+    def release(self):
+        self.count -= 1
+        if not self.count:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.lock.release()
+
+
 def _object_path(obj):
     path = []
     node = obj
     while node.parent:
-        path.insert(0, node.name)
+        path.append(node.name)
         node = node.parent
-    return "/".join(path)
+    return "/".join(reversed(path))
+
+
+def _hash_object(type, data):
+    """
+    Computes the id git would give an object of the given `type` and `data`.
+    """
+    sha1 = hashlib.sha1(b"%s %d\0" % (type, len(data)))
+    sha1.update(data)
+    return sha1.hexdigest().encode("ascii")
+
+
+def _write_object(db, type, data, oid):
+    """
+    Stores an object in the database as a loose object, just as git would,
+    unless there already is one.  The object is written to a temporary file
+    and then renamed into place, so readers never see part of an object.
+    Permissions follow the umask and `core.sharedRepository`, like git's.
+    """
+    oid = oid.decode("ascii")
+    folder = os.path.join(db, "objects", oid[:2])
+    path = os.path.join(folder, oid[2:])
+    if os.path.exists(path):
+        return
+    shared = _shared_repository(db)
+    if not os.path.isdir(folder):
+        os.makedirs(folder, exist_ok=True)
+        if shared:
+            mode = os.stat(folder).st_mode
+            os.chmod(folder, _shared_mode(shared, mode, True))
+    compress = zlib.compressobj(_LOOSE_COMPRESSION)
+    # Created read only, as git does, so the umask applies to it as well
+    tmp = os.path.join(folder, "tmp_obj_" + os.urandom(6).hex())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o444)
+    if shared:
+        os.fchmod(fd, _shared_mode(shared, os.fstat(fd).st_mode, False))
+    with os.fdopen(fd, "wb") as f:
+        f.write(compress.compress(b"%s %d\0" % (type, len(data))))
+        f.write(compress.compress(data))
+        f.write(compress.flush())
+    os.replace(tmp, path)
+
+
+def _shared_repository(db):
+    """
+    Returns git's `core.sharedRepository` setting for the database at `db`,
+    in the form git keeps it: 0 to leave permissions to the umask, the bits
+    to add for a group or everybody, or the negated mode to use exactly.
+    The setting is looked up again whenever the repository's config changes.
+    """
+    stamp = os.stat(os.path.join(db, "config")).st_mtime_ns
+    cached = _shared_repositories.get(db)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    try:
+        value = _check_output(
+            _git(db, "config", "--get", "core.sharedRepository")
+        ).strip()
+    except subprocess.CalledProcessError:
+        value = b""  # Not set
+
+    if value == b"group":
+        shared = 0o660
+    elif value in (b"all", b"world", b"everybody"):
+        shared = 0o664
+    elif value in (b"", b"umask"):
+        shared = 0
+    else:
+        try:
+            perm = int(value, 8)
+        except ValueError:
+            # Otherwise it's a boolean, where true means "group"
+            perm = int(value.lower() not in (b"false", b"no", b"off"))
+        shared = {0: 0, 1: 0o660, 2: 0o664}.get(perm, -(perm & 0o666))
+
+    _shared_repositories[db] = (stamp, shared)
+    return shared
+
+
+def _shared_mode(shared, mode, isdir):
+    """
+    Adjusts the permissions in `mode` for a shared repository, as git does.
+    """
+    tweak = abs(shared)
+    if not mode & stat.S_IWUSR:
+        tweak &= ~0o222
+    if mode & stat.S_IXUSR:
+        tweak |= (tweak & 0o444) >> 2
+    if shared < 0:
+        mode = (mode & ~0o777) | tweak
+    else:
+        mode |= tweak
+    if isdir:
+        # Copy read bits to execute bits, and have new folders inherit the
+        # group if its members can get in.
+        mode |= (mode & 0o444) >> 2
+        if mode & stat.S_IXGRP:
+            mode |= stat.S_ISGID
+        else:
+            mode &= ~stat.S_ISGID
+    return mode & 0o7777
+
+
+def _get_save_pool():
+    """
+    Returns the thread pool used to store new trees, making one if this
+    process doesn't have one yet.  A child forked from a process that has a
+    pool inherits the pool but none of its threads, so it needs its own.
+    """
+    global _save_pool
+    pid = os.getpid()
+    if _save_pool is None or _save_pool[0] != pid:
+        workers = min(os.cpu_count() or 1, 8)
+        _save_pool = (pid, concurrent.futures.ThreadPoolExecutor(workers))
+    return _save_pool[1]
+
+
+def _read_small(path):
+    """
+    Returns the contents of a small file, such as a ref, without the trailing
+    newline.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, 4096).strip()
+    finally:
+        os.close(fd)
+
+
+def _git(db, *args):
+    """
+    Builds the argument list for running a git command against the repository
+    database at `db`.  Passing the database with `--git-dir` means the child
+    process doesn't need to change directories or discover the repository.
+    """
+    return ["git", "--git-dir", db] + list(args)
 
 
 @contextlib.contextmanager
 def _popen(args, **kw):
     proc = subprocess.Popen(args, **kw)
     yield proc
-    for stream in (proc.stdin, proc.stdout, proc.stderr):
-        if stream is not None:
-            stream.close()
+    # Let communicate() close stdin and drain anything left on stdout and
+    # stderr concurrently, so the child can never be left blocked writing to a
+    # full pipe while we wait for it to exit.
+    if proc.stdin is not None and proc.stdin.closed:
+        proc.stdin = None
+    proc.communicate()
     retcode = proc.wait()
     if retcode != 0:
         raise subprocess.CalledProcessError(retcode, repr(args))
@@ -1212,6 +1801,27 @@ def _DirectoryNotEmpty(path):
     return IOError(39, "Directory not empty", path)
 
 
+# Big enough that reading a large blob doesn't take a syscall per few kilobytes
+_BLOB_BUFFER_SIZE = 1 << 20
+
+# Same as git's default for core.looseCompression
+_LOOSE_COMPRESSION = 1
+
+# Buffer size for files opened by AcidFS.open, the size of a Linux pipe
+_STREAM_BUFFER_SIZE = 1 << 16
+
+# How many parsed trees an AcidFS instance keeps around between transactions
+_TREE_CACHE_SIZE = 4096
+
+# The pool used by _TreeNode.save, with the id of the process that made it
+_save_pool = None
+
+# Lock files this process has locked, by path
+_file_locks = {}
+
+# core.sharedRepository settings by database, with the config file's mtime
+_shared_repositories = {}
+
 _MERGE_ADDED_IN_REMOTE = object()
 _MERGE_REMOVED_IN_REMOTE = object()
 _MERGE_CHANGED_IN_BOTH = object()
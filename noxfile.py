@@ -8,6 +8,10 @@ NOX_DIR = os.path.abspath(os.path.dirname(__file__))
 DEFAULT_INTERPRETER = "3.9"
 ALL_INTERPRETERS = ("3.6", "3.7", "3.8", "3.9")
 
+# Installing into a fresh virtualenv on every run costs more than the tests
+# themselves. Pass --no-reuse-existing-virtualenvs to start from scratch.
+nox.options.reuse_existing_virtualenvs = True
+
 
 def get_path(*names):
     return os.path.join(NOX_DIR, *names)
@@ -77,7 +81,8 @@ def docs(session):
 
     session.install("-e", ".[docs]")
 
-    shutil.rmtree(os.path.join("docs", "_build"), ignore_errors=True)
+    # Sphinx only rebuilds what changed since the last build. Use the
+    # clean_docs session to start over from scratch.
     session.run(
         "sphinx-build",
         "-W",  # warnings as errors
@@ -89,3 +94,9 @@ def docs(session):
         os.path.join("docs", ""),
         os.path.join("docs", "_build", "html", ""),
     )
+
+
+@nox.session(python=False)
+def clean_docs(session):
+    """Remove built docs, so the next docs session builds everything."""
+    shutil.rmtree(get_path("docs", "_build"), ignore_errors=True)
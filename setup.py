@@ -1,6 +1,5 @@
 import os
 from setuptools import setup
-from setuptools import find_packages
 
 VERSION = "2.0"
 
@@ -8,11 +7,12 @@ requires = [
     "transaction",
 ]
 
-tests_require = ["pytest", "pytest-cov", "nox"]
+tests_require = ["pytest", "pytest-cov", "pytest-xdist", "nox"]
 docs_require = ["Sphinx", "pylons-sphinx-themes"]
 
 here = os.path.abspath(os.path.dirname(__file__))
-README = open(os.path.join(here, "README.rst")).read()
+with open(os.path.join(here, "README.rst")) as f:
+    README = f.read()
 
 setup(
     name="acidfs",
@@ -30,7 +30,7 @@ setup(
     author_email="pylons-discuss@googlegroups.com",
     url="http://pylonsproject.org",
     license="BSD-derived (http://www.repoze.org/LICENSE.txt)",
-    packages=find_packages(),
+    packages=["acidfs"],
     include_package_data=True,
     zip_safe=False,
     install_requires=requires,
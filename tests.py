@@ -1,28 +1,78 @@
-import contextlib
 import io
 import os
+import pathlib
 import pytest
 import shutil
+import signal
 import subprocess
 import tempfile
+import threading
 import transaction
 
-from unittest import mock
+from acidfs import AcidFS, ConflictError, _check_output, _popen
 
-from acidfs import AcidFS, _check_output
+# Keep test repositories in memory where we can, since nearly everything the
+# tests do is git writing small files.
+TMPROOT = "/dev/shm" if os.path.isdir("/dev/shm") else None
 
+# Ids of well known objects: the empty tree and a blob holding b"Hello\n"
+EMPTY_TREE = b"4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+HELLO_BLOB = b"e965047ad7c57865823c7d992b1d046ea66edf78"
 
-@pytest.fixture
-def tmp(request):
-    tmp = tempfile.mkdtemp()
-    return tmp
+
+@pytest.fixture(scope="session", autouse=True)
+def git_identity(tmp_path_factory):
+    """
+    Gives git an identity once per session through a global config file of
+    our own, rather than configuring every test repository. Repository
+    config, such as that written by AcidFS for `user_name`, still wins.
+    GIT_CONFIG_GLOBAL needs git 2.32, so the file is also put where older
+    gits look for it, in a home directory of our own.
+    """
+    home = tmp_path_factory.mktemp("home")
+    config = home / ".gitconfig"
+    config.write_text("[user]\n\tname = Test User\n\temail = test@example.com\n")
+    with pytest.MonkeyPatch.context() as env:
+        env.setenv("HOME", str(home))
+        env.setenv("XDG_CONFIG_HOME", str(home / ".config"))
+        env.setenv("GIT_CONFIG_GLOBAL", str(config))
+        env.setenv("GIT_CONFIG_NOSYSTEM", "1")
+        yield
 
 
 @pytest.fixture
-def factory(request, tmp):
-    cwd = os.getcwd()
+def tmp():
+    tmp = tempfile.mkdtemp(dir=TMPROOT)
+    yield tmp
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def template_repo():
+    # Lives next to the test repositories, so copies of it can be hard links
+    template = tempfile.mkdtemp(dir=TMPROOT)
+    AcidFS(template)
+    yield os.path.join(template, ".git")
+    shutil.rmtree(template, ignore_errors=True)
+
+
+# Arguments that only make sense if AcidFS creates the repository itself
+INIT_ARGS = {"create", "bare", "user_name", "user_email"}
+
 
+@pytest.fixture
+def factory(request, tmp, template_repo):
     def mkstore(*args, **kw):
+        if not args and not INIT_ARGS.intersection(kw):
+            # Linking to an initialized repository is cheaper than git init.
+            # This is safe since git replaces, rather than rewrites, the files
+            # found in a freshly initialized repository.
+            dbpath = os.path.join(tmp, ".git")
+            if not os.path.exists(dbpath):
+                shutil.copytree(
+                    template_repo, dbpath, symlinks=True, copy_function=os.link
+                )
+
         store = AcidFS(tmp, *args, **kw)
 
         if "user_name" not in kw:
@@ -30,78 +80,117 @@ def factory(request, tmp):
             tx.setUser("Test User")
             tx.setExtendedInfo("email", "test@example.com")
 
-            os.chdir(tmp)
-            subprocess.check_call(["git", "config", "user.name", "Test User"])
-            subprocess.check_call(["git", "config", "user.email", "test@example.com"])
-            os.chdir(cwd)
-
         return store
 
-    def cleanup():
-        transaction.abort()
-        shutil.rmtree(tmp)
-
-    request.addfinalizer(cleanup)
+    request.addfinalizer(transaction.abort)
     return mkstore
 
 
-@contextlib.contextmanager
+@pytest.fixture(scope="module")
+def shared_repo():
+    tmp = tempfile.mkdtemp(dir=TMPROOT)
+    AcidFS(tmp)
+    yield tmp
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+@pytest.fixture
+def fs(request, shared_repo):
+    """
+    An AcidFS over a repository shared by the whole module, for tests which
+    never commit and so leave nothing behind for the next test to see.
+    """
+    request.addfinalizer(transaction.abort)
+    return AcidFS(shared_repo)
+
+
+class CatFile(object):
+    """
+    Reads objects from a repository through a single, long running
+    `git cat-file --batch` process, rather than spawning git for every read.
+    """
+
+    proc = None
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def read(self, ref):
+        proc = self.proc
+        if proc is None:  # pragma no branch
+            proc = self.proc = subprocess.Popen(
+                ["git", "cat-file", "--batch"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                cwd=self.repo,
+            )
+        proc.stdin.write(ref.encode("ascii") + b"\n")
+        proc.stdin.flush()
+        oid, type, size = proc.stdout.readline().split()
+        return proc.stdout.read(int(size) + 1)[:-1]
+
+    def close(self):
+        proc = self.proc
+        if proc is not None:  # pragma no branch
+            proc.stdin.close()
+            proc.stdout.close()
+            proc.wait()
+
+
+@pytest.fixture
+def catfile(request, tmp):
+    catfile = CatFile(tmp)
+    request.addfinalizer(catfile.close)
+    return catfile
+
+
+class assert_ioerror(object):
+    """
+    Asserts that the block it manages raises an IOError with the given errno,
+    message and filename.
+    """
+
+    def __init__(self, errno, strerror, path):
+        self.errno = errno
+        self.strerror = strerror
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, e, tb):
+        if type is None:
+            raise AssertionError("IOError not raised")  # pragma no cover
+        if not issubclass(type, IOError):
+            return False  # pragma no cover
+        assert e.errno == self.errno
+        assert e.strerror == self.strerror
+        assert e.filename == self.path
+        return True
+
+
 def assert_no_such_file_or_directory(path):
-    try:
-        yield
-        raise AssertionError("IOError not raised")  # pragma no cover
-    except IOError as e:
-        assert e.errno == 2
-        assert e.strerror == "No such file or directory"
-        assert e.filename == path
+    return assert_ioerror(2, "No such file or directory", path)
 
 
-@contextlib.contextmanager
 def assert_is_a_directory(path):
-    try:
-        yield
-        raise AssertionError("IOError not raised")  # pragma no cover
-    except IOError as e:
-        assert e.errno == 21
-        assert e.strerror == "Is a directory"
-        assert e.filename == path
+    return assert_ioerror(21, "Is a directory", path)
 
 
-@contextlib.contextmanager
 def assert_not_a_directory(path):
-    try:
-        yield
-        raise AssertionError("IOError not raised")  # pragma no cover
-    except IOError as e:
-        assert e.errno == 20
-        assert e.strerror == "Not a directory"
-        assert e.filename == path
+    return assert_ioerror(20, "Not a directory", path)
 
 
-@contextlib.contextmanager
 def assert_file_exists(path):
-    try:
-        yield
-        raise AssertionError("IOError not raised")  # pragma no cover
-    except IOError as e:
-        assert e.errno == 17
-        assert e.strerror == "File exists"
-        assert e.filename == path
+    return assert_ioerror(17, "File exists", path)
 
 
-@contextlib.contextmanager
 def assert_directory_not_empty(path):
-    try:
-        yield
-        raise AssertionError("IOError not raised")  # pragma no cover
-    except IOError as e:
-        assert e.errno == 39
-        assert e.strerror == "Directory not empty"
-        assert e.filename == path
+    return assert_ioerror(39, "Directory not empty", path)
 
 
 def test_new_repo_w_working_directory(factory, tmp):
-    factory()
+    factory(create=True)
     assert os.path.exists(os.path.join(tmp, ".git"))
 
 
@@ -113,9 +202,9 @@ def test_no_repo_dont_create(factory):
 
 def test_read_write_file(factory, tmp):
     fs = factory()
-    assert fs.hash() == b"4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+    assert fs.hash() == EMPTY_TREE
     # twice for branch coverage/excercising lazy computation and caching of the hash
-    assert fs.hash() == b"4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+    assert fs.hash() == EMPTY_TREE
     with assert_no_such_file_or_directory("foo"):
         fs.hash("foo")
     with fs.open("foo", "wb") as f:
@@ -125,8 +214,8 @@ def test_read_write_file(factory, tmp):
             fs.open("foo", "rb")
         with assert_no_such_file_or_directory("foo"):
             fs.hash("foo")
-    assert fs.open("foo", "rb").read() == b"Hello\n"
-    assert fs.hash("foo") == b"e965047ad7c57865823c7d992b1d046ea66edf78"
+    assert read_file(fs, "foo") == b"Hello\n"
+    assert fs.hash("foo") == HELLO_BLOB
     actual_file = os.path.join(tmp, "foo")
     assert not os.path.exists(actual_file)
     transaction.commit()
@@ -139,9 +228,9 @@ def test_read_write_file(factory, tmp):
     with fs.open("foo", "rb", buffering=0) as f:
         assert f.readable()
         assert f.read() == b"Hello Dad\n"
-    with open(actual_file, "rb") as f:
-        assert f.read() == b"Hello\n"
-    transaction.commit()  # Nothing to commit
+    assert pathlib.Path(actual_file).read_bytes() == b"Hello\n"
+    transaction.commit()
+    assert pathlib.Path(actual_file).read_bytes() == b"Hello Dad\n"
 
 
 def test_read_write_nonascii_name(factory):
@@ -153,23 +242,33 @@ def test_read_write_nonascii_name(factory):
     assert fs.listdir(), [filename]
 
 
+def test_read_write_odd_names(factory):
+    fs = factory()
+    names = [" leading space", "trailing space ", 'quo"te']
+    for name in names:
+        write_file(fs, name, b"Hello")
+    transaction.commit()
+    assert sorted(fs.listdir()) == sorted(names)
+    for name in names:
+        assert read_file(fs, name) == b"Hello"
+
+
 def test_read_write_text_file(factory, tmp):
     fs = factory()
     with fs.open("foo", "wt") as f:
         assert f.writable()
-        fprint(f, u"Hell\xf2")
+        fprint(f, "Hell\xf2")
         with assert_no_such_file_or_directory("foo"):
             fs.open("foo", "r")
-    assert fs.open("foo", "r").read() == u"Hell\xf2\n"
+    with fs.open("foo", "r") as f:
+        assert f.read() == "Hell\xf2\n"
     actual_file = os.path.join(tmp, "foo")
     assert not os.path.exists(actual_file)
     transaction.commit()
     with fs.open("foo", "r", buffering=1) as f:
         assert f.readable()
-        assert f.read() == u"Hell\xf2\n"
-    with open(actual_file, "rb") as f:
-        assert f.read() == b"Hell\xc3\xb2\n"
-    transaction.commit()  # Nothing to commit
+        assert f.read() == "Hell\xf2\n"
+    assert pathlib.Path(actual_file).read_bytes() == b"Hell\xc3\xb2\n"
 
 
 def test_read_write_file_in_subfolder(factory, tmp):
@@ -177,7 +276,7 @@ def test_read_write_file_in_subfolder(factory, tmp):
     assert not fs.isdir("foo")
     fs.mkdir("foo")
     assert fs.isdir("foo")
-    assert fs.hash("foo") == b"4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+    assert fs.hash("foo") == EMPTY_TREE
     with fs.open("foo/bar", "wb") as f:
         fprint(f, b"Hello")
     with fs.open("foo/bar", "rb") as f:
@@ -190,8 +289,30 @@ def test_read_write_file_in_subfolder(factory, tmp):
     assert not fs.isdir("foo/bar")
     with fs.open("foo/bar", "rb") as f:
         assert f.read() == b"Hello\n"
-    with open(actual_file, "rb") as f:
-        assert f.read() == b"Hello\n"
+    assert pathlib.Path(actual_file).read_bytes() == b"Hello\n"
+
+
+def test_trees_read_lazily(factory):
+    fs = factory()
+    fs.mkdirs("foo/bar")
+    write_file(fs, "foo/bar/baz", b"Hello")
+    transaction.commit()
+
+    fs.get_base()
+    tree = fs._session().tree
+    assert tree._contents is None
+    assert fs.hash() == tree.oid
+    assert tree._contents is None
+    assert read_file(fs, "foo/bar/baz") == b"Hello"
+    assert tree._contents is not None
+    assert tree.get("foo")._contents is not None
+
+
+def test_open_new_file_in_subfolder_for_reading(fs):
+    fs.mkdirs("foo/bar")
+    with fs.open("foo/bar/baz", "wb"):
+        with assert_no_such_file_or_directory("foo/bar/baz"):
+            fs.open("foo/bar/baz", "rb")
 
 
 def test_read_write_file_in_subfolder_bare_repo(factory):
@@ -213,9 +334,9 @@ def test_read_write_file_in_subfolder_bare_repo(factory):
 def test_append_twice_to_same_file(factory):
     fs = factory()
     with fs.open("foo", "a") as f:
-        fprint(f, u"One")
+        fprint(f, "One")
     with fs.open("foo", "a") as f:
-        fprint(f, u"Two")
+        fprint(f, "Two")
     with fs.open("foo") as f:
         assert f.read() == ("One\n" "Two\n")
     transaction.commit()
@@ -223,9 +344,7 @@ def test_append_twice_to_same_file(factory):
         assert f.read() == ("One\n" "Two\n")
 
 
-def test_open_edge_cases(factory):
-    fs = factory()
-
+def test_open_edge_cases(fs):
     with assert_no_such_file_or_directory("foo"):
         fs.open("foo", "rb")
 
@@ -243,7 +362,7 @@ def test_open_edge_cases(factory):
     with assert_is_a_directory("foo"):
         fs.open("foo", "wb")
 
-    fs.open("bar", "wb").write(b"Howdy")
+    write_file(fs, "bar", b"Howdy")
 
     with assert_not_a_directory("bar/foo"):
         fs.open("bar/foo", "wb")
@@ -280,13 +399,12 @@ def test_open_edge_cases(factory):
         f.write("hi mom!")
 
 
-def test_mkdir_edge_cases(factory):
-    fs = factory()
+def test_mkdir_edge_cases(fs):
 
     with assert_no_such_file_or_directory("foo/bar"):
         fs.mkdir("foo/bar")
 
-    fs.open("foo", "wb").write(b"Howdy!")
+    write_file(fs, "foo", b"Howdy!")
 
     with assert_not_a_directory("foo/bar"):
         fs.mkdir("foo/bar")
@@ -296,84 +414,84 @@ def test_mkdir_edge_cases(factory):
         fs.mkdir("bar")
 
 
-def test_commit_name_and_email_from_factory(factory, tmp):
+def test_commit_name_and_email_from_factory(factory, catfile):
     fs = factory(user_name="Fred Flintstone", user_email="fred@bed.rock")
-    fs.open("foo", "wb").write(b"Howdy!")
+    write_file(fs, "foo", b"Howdy!")
     transaction.commit()
 
-    output = _check_output(["git", "log"], cwd=tmp)
-    assert b"Author: Fred Flintstone <fred@bed.rock>" in output
+    commit = catfile.read("HEAD")
+    assert b"\nauthor Fred Flintstone <fred@bed.rock> " in commit
 
 
-def test_commit_metadata(factory, tmp):
+def test_commit_metadata(factory, catfile):
     fs = factory()
     tx = transaction.get()
     tx.note("A test commit.")
     tx.setUser("Fred Flintstone")
     tx.setExtendedInfo("email", "fred@bed.rock")
-    fs.open("foo", "wb").write(b"Howdy!")
+    write_file(fs, "foo", b"Howdy!")
     transaction.commit()
 
-    output = _check_output(["git", "log"], cwd=tmp)
-    assert b"Author: Fred Flintstone <fred@bed.rock>" in output
-    assert b"A test commit." in output
+    commit = catfile.read("HEAD")
+    assert b"\nauthor Fred Flintstone <fred@bed.rock> " in commit
+    assert b"A test commit." in commit
 
 
-def test_commit_metadata_blank_name(factory, tmp):
+def test_commit_metadata_blank_name(factory, catfile):
     fs = factory()
     tx = transaction.get()
     tx.note("A test commit.")
     tx.setUser("")
     tx.setExtendedInfo("email", "fred@bed.rock")
-    fs.open("foo", "wb").write(b"Howdy!")
+    write_file(fs, "foo", b"Howdy!")
     transaction.commit()
 
-    output = _check_output(["git", "log"], cwd=tmp)
-    assert b"Author: / <fred@bed.rock>" in output
-    assert b"A test commit." in output
+    commit = catfile.read("HEAD")
+    assert b"\nauthor / <fred@bed.rock> " in commit
+    assert b"A test commit." in commit
 
 
-def test_commit_metadata_for_acidfs(factory, tmp):
+def test_commit_metadata_for_acidfs(factory, catfile):
     fs = factory()
     tx = transaction.get()
     tx.note("A test commit.")
     tx.extension["acidfs_user"] = "Fred Flintstone"
     tx.extension["acidfs_email"] = "fred@bed.rock"
-    fs.open("foo", "wb").write(b"Howdy!")
+    write_file(fs, "foo", b"Howdy!")
     transaction.commit()
 
-    output = _check_output(["git", "log"], cwd=tmp)
-    assert b"Author: Fred Flintstone <fred@bed.rock>" in output
-    assert b"A test commit." in output
+    commit = catfile.read("HEAD")
+    assert b"\nauthor Fred Flintstone <fred@bed.rock> " in commit
+    assert b"A test commit." in commit
 
 
-def test_commit_metadata_user_path_is_blank(factory, tmp):
+def test_commit_metadata_user_path_is_blank(factory, catfile):
     # pyramid_tm calls setUser with '' for path
     fs = factory()
     tx = transaction.get()
     tx.note("A test commit.")
     tx.setUser("Fred", "")
     tx.setExtendedInfo("email", "fred@bed.rock")
-    fs.open("foo", "wb").write(b"Howdy!")
+    write_file(fs, "foo", b"Howdy!")
     transaction.commit()
 
-    output = _check_output(["git", "log"], cwd=tmp)
-    assert b"Author: Fred <fred@bed.rock>" in output
-    assert b"A test commit." in output
+    commit = catfile.read("HEAD")
+    assert b"\nauthor Fred <fred@bed.rock> " in commit
+    assert b"A test commit." in commit
 
 
-def test_commit_metadata_extended_info_for_user(factory, tmp):
+def test_commit_metadata_extended_info_for_user(factory, catfile):
     fs = factory()
     tx = transaction.get()
     tx.note("A test commit.")
     tx.setExtendedInfo("user", "Fred Flintstone")
     tx.setExtendedInfo("email", "fred@bed.rock")
-    fs.open("foo", "wb").write(b"Howdy!")
+    write_file(fs, "foo", b"Howdy!")
     transaction.commit()
 
-    output = _check_output(["git", "log"], cwd=tmp)
-    assert b"Author: Fred Flintstone <fred@bed.rock>" in output
-    assert b"A test commit." in output
+    commit = catfile.read("HEAD")
+    assert b"\nauthor Fred Flintstone <fred@bed.rock> " in commit
+    assert b"A test commit." in commit
 
 
 def test_modify_file(factory, tmp):
@@ -385,33 +503,306 @@ def test_modify_file(factory, tmp):
     path = os.path.join(tmp, "foo")
     with fs.open("foo", "wb") as f:
         fprint(f, b"Hello!")
-        assert fs.open("foo", "rb").read() == b"Howdy!\n"
+        assert read_file(fs, "foo") == b"Howdy!\n"
         assert fs.hash("foo") == b"c564dac563c1974addaa0ac0ae028fc92b2370f1"
-    assert fs.open("foo", "rb").read() == b"Hello!\n"
+    assert read_file(fs, "foo") == b"Hello!\n"
     assert fs.hash("foo") == b"10ddd6d257e01349d514541981aeecea6b2e741d"
-    assert open(path, "rb").read() == b"Howdy!\n"
+    assert pathlib.Path(path).read_bytes() == b"Howdy!\n"
     transaction.commit()
 
-    assert open(path, "rb").read() == b"Hello!\n"
+    assert pathlib.Path(path).read_bytes() == b"Hello!\n"
 
 
-def test_error_writing_blob(factory):
+def test_error_writing_blob(factory, tmp):
     fs = factory()
-    with pytest.raises((IOError, subprocess.CalledProcessError)):
-        with fs.open("foo", "wb") as f:
-            wait = f.raw.proc.wait
+    oid = _check_output(["git", "hash-object", "--stdin"], input=b"Howdy!\n")
+    oid = oid.decode("ascii")
 
-            def dummy_wait():
-                wait()
-                return 1
+    # Put something in the way of the folder the blob would be stored in
+    pathlib.Path(tmp, ".git", "objects", oid[:2]).touch()
+    f = fs.open("foo", "wb")
+    fprint(f, b"Howdy!")
+    with pytest.raises(IOError):
+        f.close()
+    f.raw.close()  # Closing twice is harmless
 
-            f.raw.proc.wait = dummy_wait
-            fprint(f, b"Howdy!")
 
+def test_error_reading_blob(fs):
+    # Bigger than a pipe's buffer, so git is still writing when it's killed
+    write_file(fs, "foo", b"a" * (4 << 20))
+    with pytest.raises(subprocess.CalledProcessError):
+        with fs.open("foo", "rb") as f:
+            f.raw.catfile.proc.kill()
+            f.read()
+
+    # The next read starts over with a new process
+    assert read_file(fs, "foo") == b"a" * (4 << 20)
+
+
+def test_error_reading_missing_blob(fs):
+    catfile = fs._session().catfile
+    with pytest.raises(subprocess.CalledProcessError):
+        catfile.open(b"0" * 40)
+
+
+def test_read_blobs_concurrently(fs):
+    write_file(fs, "foo", b"Hello!\n")
+    write_file(fs, "bar", b"a" * (4 << 20))
+    catfile = fs._session().catfile
+    with fs.open("foo", "rb") as foo:
+        assert foo.raw is catfile.stream()
+        with fs.open("bar", "rb") as bar:
+            # The batch process is busy, so bar gets a process of its own
+            assert bar.raw is not catfile.stream()
+            assert bar.read(5) == b"aaaaa"
+            assert bar.read() == b"a" * ((4 << 20) - 5)
+        assert foo.read() == b"Hello!\n"
+    # Reading a blob to the end leaves the process running
+    assert catfile.proc is not None
+
+    # Closing a stream part way through a big blob stops the process
+    with fs.open("bar", "rb", buffering=0) as bar:
+        assert bar.read(5) == b"aaaaa"
+    assert catfile.proc is None
+
+    # Closing a stream part way through a small blob skips the rest of it
+    with fs.open("foo", "rb", buffering=0) as foo:
+        assert foo.read(5) == b"Hello"
+    proc = catfile.proc
+    assert proc is not None
+    assert read_file(fs, "foo") == b"Hello!\n"
+    assert catfile.proc is proc
+
+    # Closing the cat-file process while a blob is being read waits for the
+    # read to finish
+    foo = fs.open("foo", "rb")
+    catfile.close()
+    assert catfile.proc is proc
+    assert foo.read() == b"Hello!\n"
+    foo.close()
+    assert catfile.proc is None
+    foo.raw.close()  # Closing twice is harmless
+
+    # A closed cat-file doesn't start new processes
+    with fs.open("foo", "rb") as foo:
+        assert catfile.stream is None
+        assert foo.read() == b"Hello!\n"
+    assert catfile.proc is None
+
+
+def test_catfile_kept_between_transactions(factory):
+    fs = factory()
+    write_file(fs, "foo", b"Hello!\n")
+    transaction.commit()
+    assert read_file(fs, "foo") == b"Hello!\n"
+    proc = fs._session().catfile.proc
+    transaction.commit()
+
+    assert read_file(fs, "foo") == b"Hello!\n"
+    assert fs._session().catfile.proc is proc
+    transaction.abort()
+
+    # A process that died between transactions is replaced
+    proc.kill()
+    proc.wait()
+    assert read_file(fs, "foo") == b"Hello!\n"
+    assert fs._session().catfile.proc is not proc
+    transaction.abort()
+
+    # As is a process that was closed
+    catfile = fs._session().catfile
+    catfile.close()
+    transaction.abort()
+    assert fs._session().catfile is not catfile
+
+    # The process stops when the AcidFS goes away
+    assert read_file(fs, "foo") == b"Hello!\n"
+    proc = fs._session().catfile.proc
+    transaction.abort()
+    del fs
+    assert proc.poll() is not None
+
+
+def test_read_tree_while_reading_blob(factory):
+    fs = factory()
+    write_file(fs, "foo", b"Hello!\n")
+    fs.mkdir("bar")
+    write_file(fs, "bar/baz", b"Howdy!\n")
+    transaction.commit()
+
+    with fs.open("foo", "rb") as foo:
+        # The batch process is busy, so the tree is read by git on its own
+        assert fs.listdir("bar") == ["baz"]
+        assert foo.read() == b"Hello!\n"
+
+
+def test_error_reading_tree(fs):
+    catfile = fs._session().catfile
+    assert catfile.read("tree", EMPTY_TREE) == b""
+
+    # Git goes away before sending all of the object
+    catfile.proc.kill()
+    catfile.proc.wait()
+    catfile._request = lambda oid: 100
+    with pytest.raises(subprocess.CalledProcessError):
+        catfile.read("tree", EMPTY_TREE)
+    assert catfile.proc is None
+
+
+def test_blob_stream_not_closed(fs):
+    write_file(fs, "foo", b"Hello!\n")
+    catfile = fs._session().catfile
+
+    # A stream dropped without being closed still lets go of the process
+    assert fs.open("foo", "rb", buffering=0).read(1) == b"H"
+    assert catfile.stream is None
+    proc = catfile.proc
+    with fs.open("foo", "rb") as foo:
+        assert foo.raw is catfile.stream()
+        assert foo.read() == b"Hello!\n"
+    assert catfile.proc is proc
+
+
+def test_catfile_goes_away(fs):
+    write_file(fs, "foo", b"Hello!\n")
+    oid = fs.hash("foo")
+    catfile = fs._session().catfile
+
+    # Git goes away before sending the rest of a blob that's being skipped
+    foo = fs.open("foo", "rb", buffering=0)
+    assert foo.read(1) == b"H"
+    catfile.proc.kill()
+    catfile.proc.wait()
+    foo.remaining = 1000
+    foo.close()
+    assert catfile.proc is None
+
+    # The process is let go of while a blob is being read from it
+    foo = fs.open("foo", "rb", buffering=0)
+    catfile.stop()
+    with pytest.raises(subprocess.CalledProcessError):
+        foo.read()
+    foo.close()
+    assert catfile.stream is None
+
+    # Git goes away between objects
+    assert catfile.read("blob", oid) == b"Hello!\n"
+    catfile.proc.kill()
+    catfile.proc.wait()
+    with pytest.raises(subprocess.CalledProcessError):
+        catfile.read("blob", oid)
+    assert catfile.proc is None
+    assert read_file(fs, "foo") == b"Hello!\n"
+
+
+def test_read_tree_with_submodule(factory, tmp):
+    fs = factory()
+    write_file(fs, "foo", b"Hello!\n")
+    transaction.commit()
+
+    sub = fs.get_base()
+    listing = _check_output(["git", "ls-tree", "HEAD"], cwd=tmp)
+    listing += b"160000 commit %s\tsub\n" % sub
+    tree = _check_output(["git", "mktree"], input=listing, cwd=tmp).strip()
+    commit = _check_output(
+        ["git", "commit-tree", tree, "-p", "HEAD", "-m", "Add submodule"], cwd=tmp
+    ).strip()
+    git(tmp, "update-ref", "HEAD", commit)
+
+    fs = factory()
+    assert sorted(fs.listdir()) == ["foo", "sub"]
+
+    # Saving the tree keeps the submodule a submodule
+    write_file(fs, "bar", b"Howdy!\n")
+    transaction.commit()
+
+    listing = _check_output(["git", "ls-tree", "HEAD"], cwd=tmp)
+    assert b"160000 commit %s\tsub\n" % sub in listing
+    assert read_file(fs, "bar") == b"Howdy!\n"
+    git(tmp, "fsck", "--strict")
+
+
+def test_save_keeps_modes(factory, tmp):
+    fs = factory()
+    write_file(fs, "foo", b"Hello!\n")
+    transaction.commit()
+
+    foo = fs.hash("foo")
+    listing = b"100755 blob %s\texe\n120000 blob %s\tlink\n" % (foo, foo)
+    tree = _check_output(["git", "mktree"], input=listing, cwd=tmp).strip()
+    commit = _check_output(
+        ["git", "commit-tree", tree, "-p", "HEAD", "-m", "Odd modes"], cwd=tmp
+    ).strip()
+    git(tmp, "update-ref", "HEAD", commit)
 
-def test_error_reading_blob(factory):
     fs = factory()
-    fs.open("foo", "wb").write(b"a" * 10000)
+    fs.mv("exe", "moved")
+    write_file(fs, "new", b"Howdy!\n")
+    transaction.commit()
+
+    listing = _check_output(["git", "ls-tree", "HEAD"], cwd=tmp)
+    assert listing.splitlines() == [
+        b"120000 blob %s\tlink" % foo,
+        b"100755 blob %s\tmoved" % foo,
+        b"100644 blob %s\tnew" % fs.hash("new"),
+    ]
+
+
+@pytest.mark.parametrize(
+    "shared", ["false", "group", "all", "0640", "0600", "true", "2"]
+)
+def test_shared_repository(factory, tmp, shared):
+    fs = factory()
+    git(tmp, "config", "core.sharedRepository", shared)
+    umask = os.umask(0o077)
+    try:
+        write_file(fs, "foo", b"Shared!\n")
+        transaction.commit()
+
+        # Move our object aside and have git write the same one for comparison
+        oid = fs.hash("foo").decode("ascii")
+        theirs = pathlib.Path(tmp, ".git", "objects", oid[:2])
+        ours = theirs.rename(theirs.with_name("ours"))
+        git(tmp, "hash-object", "-w", "foo")
+    finally:
+        os.umask(umask)
+
+    assert ours.stat().st_mode == theirs.stat().st_mode
+    assert (ours / oid[2:]).stat().st_mode == (theirs / oid[2:]).stat().st_mode
+
+
+def test_trees_cached_between_transactions(factory, monkeypatch):
+    fs = factory()
+    fs.mkdirs("a/b")
+    write_file(fs, "a/b/c", b"Hello!\n")
+    transaction.commit()
+    assert read_file(fs, "a/b/c") == b"Hello!\n"
+    transaction.commit()
+
+    # Changes made in a transaction don't leak into the cache
+    write_file(fs, "a/d", b"Howdy!\n")
+    transaction.abort()
+
+    def read(type, oid):
+        raise AssertionError("Tree should be cached")  # pragma no cover
+
+    catfile = fs._session().catfile
+    catfile.read = read
+    assert fs.listdir("a") == ["b"]
+    assert read_file(fs, "a/b/c") == b"Hello!\n"
+    transaction.abort()
+    del catfile.read
+
+    # Least recently used trees are let go
+    monkeypatch.setattr("acidfs._TREE_CACHE_SIZE", 1)
+    fs._trees.clear()
+    assert fs.listdir("a/b") == ["c"]
+    assert list(fs._trees) == [fs.hash("a/b")]
+
+
+def test_error_reading_blob_without_batch(fs):
+    write_file(fs, "foo", b"a" * 10000)
+    fs._session().catfile.close()
     with pytest.raises(subprocess.CalledProcessError):
         with fs.open("foo", "rb") as f:
             wait = f.raw.proc.wait
@@ -426,25 +817,51 @@ def test_error_reading_blob(factory):
 
 def test_append(factory, tmp):
     fs = factory()
-    fs.open("foo", "wb").write(b"Hello!\n")
+    write_file(fs, "foo", b"Hello!\n")
     transaction.commit()
 
     path = os.path.join(tmp, "foo")
     with fs.open("foo", "ab") as f:
         fprint(f, b"Daddy!")
-        assert fs.open("foo", "rb").read() == b"Hello!\n"
-        assert open(path, "rb").read() == b"Hello!\n"
-    assert fs.open("foo", "rb").read() == b"Hello!\nDaddy!\n"
-    assert open(path, "rb").read() == b"Hello!\n"
+        assert read_file(fs, "foo") == b"Hello!\n"
+        assert pathlib.Path(path).read_bytes() == b"Hello!\n"
+    assert read_file(fs, "foo") == b"Hello!\nDaddy!\n"
+    assert pathlib.Path(path).read_bytes() == b"Hello!\n"
+
+    transaction.commit()
+    assert read_file(fs, "foo") == b"Hello!\nDaddy!\n"
+    assert pathlib.Path(path).read_bytes() == b"Hello!\nDaddy!\n"
+
+
+def test_append_large_file(factory):
+    fs = factory()
+    data = b"0123456789abcdef" * 65536
+    write_file(fs, "foo", data)
+    transaction.commit()
+
+    with fs.open("foo", "ab") as f:
+        f.write(b"Daddy!")
+    assert read_file(fs, "foo") == data + b"Daddy!"
+
 
+def test_append_while_reading(factory):
+    fs = factory()
+    write_file(fs, "foo", b"Hello!\n")
     transaction.commit()
-    assert fs.open("foo", "rb").read() == b"Hello!\nDaddy!\n"
-    assert open(path, "rb").read() == b"Hello!\nDaddy!\n"
+
+    # The cat-file process is busy with the reader, so the copy made for
+    # appending has to be read some other way.
+    with fs.open("foo", "rb") as reader:
+        assert reader.read(1) == b"H"
+        with fs.open("foo", "ab") as f:
+            fprint(f, b"Daddy!")
+        assert reader.read() == b"ello!\n"
+    assert read_file(fs, "foo") == b"Hello!\nDaddy!\n"
 
 
 def test_rm(factory, tmp):
     fs = factory()
-    fs.open("foo", "wb").write(b"Hello\n")
+    write_file(fs, "foo", b"Hello\n")
     transaction.commit()
 
     path = os.path.join(tmp, "foo")
@@ -466,7 +883,7 @@ def test_rm(factory, tmp):
 def test_rmdir(factory, tmp):
     fs = factory()
     fs.mkdir("foo")
-    fs.open("foo/bar", "wb").write(b"Hello\n")
+    write_file(fs, "foo/bar", b"Hello\n")
     transaction.commit()
 
     path = os.path.join(tmp, "foo")
@@ -489,7 +906,7 @@ def test_rmdir(factory, tmp):
 def test_rmtree(factory, tmp):
     fs = factory()
     fs.mkdirs("foo/bar")
-    fs.open("foo/bar/baz", "wb").write(b"Hello\n")
+    write_file(fs, "foo/bar/baz", b"Hello\n")
     with assert_not_a_directory("foo/bar/baz/boz"):
         fs.mkdirs("foo/bar/baz/boz")
     transaction.commit()
@@ -512,18 +929,80 @@ def test_rmtree(factory, tmp):
     assert not os.path.exists(path)
 
 
-def test_cant_remove_root_dir(factory):
+def test_trees_written_as_loose_objects(factory, tmp):
+    fs = factory()
+    fs.mkdirs("a/b")
+    write_file(fs, "a/b/c", b"Hello!\n")
+    transaction.commit()
+
+    oid = fs.hash("a/b").decode("ascii")
+    folder = os.path.join(tmp, ".git", "objects", oid[:2])
+    assert os.stat(os.path.join(folder, oid[2:])).st_mode & 0o777 == 0o444
+    assert not [name for name in os.listdir(folder) if name.startswith("tmp_")]
+    git(tmp, "fsck", "--strict")
+
+
+def test_save_wide_tree(factory):
+    fs = factory()
+    for i in range(20):
+        fs.mkdirs("d%d/sub" % i)
+        write_file(fs, "d%d/sub/foo" % i, b"%d" % i)
+    transaction.commit()
+
+    for i in range(20):
+        assert read_file(fs, "d%d/sub/foo" % i) == b"%d" % i
+
+
+def test_save_in_forked_child(factory, tmp):
+    fs = factory()
+    fs.mkdirs("a/b")
+    write_file(fs, "a/b/c", b"Hello!\n")
+    transaction.commit()
+
+    pid = os.fork()
+    if pid == 0:  # pragma no cover (coverage isn't collected in the child)
+        status = 1
+        try:
+            # Don't wait forever on a pool whose threads were left behind
+            signal.alarm(10)
+            fs = AcidFS(tmp)
+            fs.mkdirs("d/e")
+            write_file(fs, "d/e/f", b"Howdy!\n")
+            transaction.commit()
+            status = 0
+        finally:
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    assert read_file(fs, "d/e/f") == b"Howdy!\n"
+
+
+def test_tree_entry_order(factory, tmp):
     fs = factory()
+    fs.mkdir("a")
+    write_file(fs, "a/b", b"Hello")
+    write_file(fs, "a.b", b"Hello")
+    write_file(fs, "a-b", b"Hello")
+    write_file(fs, "a0", b"Hello")
+    transaction.commit()
+
+    # git mktree sorts its input, so it produces the canonical tree
+    listing = _check_output(["git", "ls-tree", "HEAD"], cwd=tmp)
+    expected = _check_output(["git", "mktree"], input=listing, cwd=tmp).strip()
+    assert fs.hash() == expected
+
+
+def test_cant_remove_root_dir(fs):
     with pytest.raises(ValueError):
         fs.rmdir("/")
     with pytest.raises(ValueError):
         fs.rmtree("/")
 
 
-def test_empty(factory):
-    fs = factory()
+def test_empty(fs):
     assert fs.empty("/")
-    fs.open("foo", "wb").write(b"Hello!")
+    write_file(fs, "foo", b"Hello!")
     assert not fs.empty("/")
     with assert_not_a_directory("foo"):
         fs.empty("foo")
@@ -535,8 +1014,8 @@ def test_mv(factory, tmp):
     fs = factory()
     fs.mkdirs("one/a")
     fs.mkdirs("one/b")
-    fs.open("one/a/foo", "wb").write(b"Hello!")
-    fs.open("one/b/foo", "wb").write(b"Howdy!")
+    write_file(fs, "one/a/foo", b"Hello!")
+    write_file(fs, "one/b/foo", b"Howdy!")
     transaction.commit()
 
     with assert_no_such_file_or_directory("/"):
@@ -547,42 +1026,46 @@ def test_mv(factory, tmp):
         fs.mv("one", "bar/baz")
 
     pexists = os.path.exists
-    j = os.path.join
+    one_a = os.path.join(tmp, "one", "a")
+    one_a_foo = os.path.join(one_a, "foo")
+    one_a_bar = os.path.join(one_a, "bar")
+    one_b_foo = os.path.join(tmp, "one", "b", "foo")
+    one_b_a = os.path.join(tmp, "one", "b", "a")
     fs.mv("one/a/foo", "one/a/bar")
     assert not fs.exists("one/a/foo")
     assert fs.exists("one/a/bar")
-    assert pexists(j(tmp, "one", "a", "foo"))
-    assert not pexists(j(tmp, "one", "a", "bar"))
+    assert pexists(one_a_foo)
+    assert not pexists(one_a_bar)
 
     transaction.commit()
     assert not fs.exists("one/a/foo")
     assert fs.exists("one/a/bar")
-    assert not pexists(j(tmp, "one", "a", "foo"))
-    assert pexists(j(tmp, "one", "a", "bar"))
+    assert not pexists(one_a_foo)
+    assert pexists(one_a_bar)
 
     fs.mv("one/b/foo", "one/a/bar")
     assert not fs.exists("one/b/foo")
-    assert fs.open("one/a/bar", "rb").read() == b"Howdy!"
-    assert pexists(j(tmp, "one", "b", "foo"))
-    assert open(j(tmp, "one", "a", "bar"), "rb").read() == b"Hello!"
+    assert read_file(fs, "one/a/bar") == b"Howdy!"
+    assert pexists(one_b_foo)
+    assert pathlib.Path(one_a_bar).read_bytes() == b"Hello!"
 
     transaction.commit()
     assert not fs.exists("one/b/foo")
-    assert fs.open("one/a/bar", "rb").read() == b"Howdy!"
-    assert not pexists(j(tmp, "one", "b", "foo"))
-    assert open(j(tmp, "one", "a", "bar"), "rb").read() == b"Howdy!"
+    assert read_file(fs, "one/a/bar") == b"Howdy!"
+    assert not pexists(one_b_foo)
+    assert pathlib.Path(one_a_bar).read_bytes() == b"Howdy!"
 
     fs.mv("one/a", "one/b")
     assert not fs.exists("one/a")
     assert fs.exists("one/b/a")
-    assert pexists(j(tmp, "one", "a"))
-    assert not pexists(j(tmp, "one", "b", "a"))
+    assert pexists(one_a)
+    assert not pexists(one_b_a)
 
     transaction.commit()
     assert not fs.exists("one/a")
     assert fs.exists("one/b/a")
-    assert not pexists(j(tmp, "one", "a"))
-    assert pexists(j(tmp, "one", "b", "a"))
+    assert not pexists(one_a)
+    assert pexists(one_b_a)
 
 
 def test_mv_noop(factory):
@@ -590,23 +1073,23 @@ def test_mv_noop(factory):
     Tests an error report from Hasan Karahan.
     """
     fs = factory()
-    fs.open("foo", "wb").write(b"Hello!")
+    write_file(fs, "foo", b"Hello!")
     fs.mv("foo", "foo")
-    assert fs.open("foo", "rb").read() == b"Hello!"
+    assert read_file(fs, "foo") == b"Hello!"
     transaction.commit()
-    assert fs.open("foo", "rb").read() == b"Hello!"
+    assert read_file(fs, "foo") == b"Hello!"
 
     fs.mv("foo", "foo")
-    assert fs.open("foo", "rb").read() == b"Hello!"
+    assert read_file(fs, "foo") == b"Hello!"
     transaction.commit()
-    assert fs.open("foo", "rb").read() == b"Hello!"
+    assert read_file(fs, "foo") == b"Hello!"
 
 
 def test_listdir(factory):
     fs = factory()
     fs.mkdirs("one/a")
     fs.mkdir("two")
-    fs.open("three", "wb").write(b"Hello!")
+    write_file(fs, "three", b"Hello!")
 
     with assert_no_such_file_or_directory("bar"):
         fs.listdir("bar")
@@ -620,13 +1103,11 @@ def test_listdir(factory):
     assert fs.listdir("/one") == ["a"]
 
 
-def test_chdir(factory):
-    fs = factory()
-
+def test_chdir(fs):
     fs.mkdirs("one/a")
     fs.mkdir("two")
-    fs.open("three", "wb").write(b"Hello!")
-    fs.open("two/three", "wb").write(b"Haha!")
+    write_file(fs, "three", b"Hello!")
+    write_file(fs, "two/three", b"Haha!")
 
     assert fs.cwd() == "/"
     assert sorted(fs.listdir()) == ["one", "three", "two"]
@@ -645,8 +1126,8 @@ def test_chdir(factory):
     with fs.cd("/two"):
         assert fs.cwd() == "/two"
         assert fs.listdir() == ["three"]
-        assert fs.open("three", "rb").read() == b"Haha!"
-        assert fs.open("/three", "rb").read() == b"Hello!"
+        assert read_file(fs, "three") == b"Haha!"
+        assert read_file(fs, "/three") == b"Hello!"
 
     assert fs.cwd() == "/one"
     assert fs.listdir() == ["a"]
@@ -661,8 +1142,7 @@ def test_nochange_commit(factory, tmp):
 
     assert count_commits(tmp) == 1
 
-    with open(os.path.join(tmp, "foo"), "r") as f:
-        assert f.read() == "hi mom!"
+    assert pathlib.Path(tmp, "foo").read_text() == "hi mom!"
 
     with fs.open("foo", "w") as f:
         f.write("hi mom!")
@@ -672,41 +1152,85 @@ def test_nochange_commit(factory, tmp):
     assert count_commits(tmp) == 1
 
 
-def test_conflict_error_on_first_commit(factory, tmp):
-    from acidfs import ConflictError
+def test_nochange_commit_in_subfolder(factory, tmp):
+    fs = factory()
+    fs.mkdirs("foo/bar")
+    write_file(fs, "foo/bar/baz", b"Hello!")
+    write_file(fs, "foo/bar/boz", b"Howdy!")
+    transaction.commit()
+    tree = fs.hash("foo")
+
+    fs.rm("foo/bar/baz")
+    assert fs.hash("foo") != tree
+    write_file(fs, "foo/bar/baz", b"Hello!")
+    assert fs.hash("foo") == tree
+    transaction.commit()
+
+    assert count_commits(tmp) == 1
+
+
+def test_nochange_commit_after_set_base(factory, tmp):
+    fs = factory()
+    write_file(fs, "foo", b"Hello!")
+    transaction.commit()
+
+    fs.set_base(fs.get_base())
+    write_file(fs, "foo", b"Hello!")
+    transaction.commit()
+
+    assert count_commits(tmp) == 1
 
+
+def test_commit_after_nothing_to_commit(factory, tmp):
     fs = factory()
-    fs.open("foo", "wb").write(b"Hello!")
-    open(os.path.join(tmp, "foo"), "wb").write(b"Howdy!")
-    _check_output(["git", "add", "."], cwd=tmp)
-    _check_output(["git", "commit", "-m", "Haha!  First!"], cwd=tmp)
+    write_file(fs, "foo", b"Hello!")
+    transaction.commit()
+
+    # Only reads, so there is nothing to commit
+    with fs.open("foo", "rb") as f:
+        assert f.read() == b"Hello!"
+    transaction.commit()
+
+    write_file(fs, "foo", b"Howdy!")
+    transaction.commit()
+
+    assert count_commits(tmp) == 2
+    assert pathlib.Path(tmp, "foo").read_bytes() == b"Howdy!"
+
+
+@pytest.mark.slow
+def test_conflict_error_on_first_commit(factory, tmp):
+    fs = factory()
+    write_file(fs, "foo", b"Hello!")
+    pathlib.Path(tmp, "foo").write_bytes(b"Howdy!")
+    git(tmp, "add", ".")
+    git(tmp, "commit", "-m", "Haha!  First!")
     with pytest.raises(ConflictError):
         transaction.commit()
 
 
+@pytest.mark.slow
 def test_unable_to_merge_file(factory, tmp):
-    from acidfs import ConflictError
-
     fs = factory()
-    fs.open("foo", "wb").write(b"Hello!")
+    write_file(fs, "foo", b"Hello!")
     transaction.commit()
-    fs.open("foo", "wb").write(b"Party!")
-    open(os.path.join(tmp, "foo"), "wb").write(b"Howdy!")
-    _check_output(["git", "add", "."], cwd=tmp)
-    _check_output(["git", "commit", "-m", "Haha!  First!"], cwd=tmp)
+    write_file(fs, "foo", b"Party!")
+    pathlib.Path(tmp, "foo").write_bytes(b"Howdy!")
+    git(tmp, "commit", "-am", "Haha!  First!")
     with pytest.raises(ConflictError):
         transaction.commit()
 
 
+@pytest.mark.slow
 def test_merge_add_file(factory, tmp):
     fs = factory()
-    fs.open("foo", "wb").write(b"Hello!\n")
+    write_file(fs, "foo", b"Hello!\n")
     transaction.commit()
 
-    fs.open("bar", "wb").write(b"Howdy!\n")
-    open(os.path.join(tmp, "baz"), "wb").write(b"Ciao!\n")
-    _check_output(["git", "add", "baz"], cwd=tmp)
-    _check_output(["git", "commit", "-m", "haha"], cwd=tmp)
+    write_file(fs, "bar", b"Howdy!\n")
+    pathlib.Path(tmp, "baz").write_bytes(b"Ciao!\n")
+    git(tmp, "add", "baz")
+    git(tmp, "commit", "-m", "haha")
     transaction.commit()
 
     assert fs.exists("foo")
@@ -714,16 +1238,17 @@ def test_merge_add_file(factory, tmp):
     assert fs.exists("baz")
 
 
+@pytest.mark.slow
 def test_merge_rm_file(factory, tmp):
     fs = factory(head="master")
-    fs.open("foo", "wb").write(b"Hello\n")
-    fs.open("bar", "wb").write(b"Grazie\n")
-    fs.open("baz", "wb").write(b"Prego\n")
+    write_file(fs, "foo", b"Hello\n")
+    write_file(fs, "bar", b"Grazie\n")
+    write_file(fs, "baz", b"Prego\n")
     transaction.commit()
 
     fs.rm("foo")
-    _check_output(["git", "rm", "baz"], cwd=tmp)
-    _check_output(["git", "commit", "-m", "gotcha"], cwd=tmp)
+    git(tmp, "rm", "baz")
+    git(tmp, "commit", "-m", "gotcha")
     transaction.commit()
 
     assert not fs.exists("foo")
@@ -731,10 +1256,11 @@ def test_merge_rm_file(factory, tmp):
     assert not fs.exists("baz")
 
 
+@pytest.mark.slow
 def test_merge_rm_same_file(factory, tmp):
     fs = factory(head="master")
-    fs.open("foo", "wb").write(b"Hello\n")
-    fs.open("bar", "wb").write(b"Grazie\n")
+    write_file(fs, "foo", b"Hello\n")
+    write_file(fs, "bar", b"Grazie\n")
     transaction.commit()
 
     base = fs.get_base()
@@ -744,49 +1270,50 @@ def test_merge_rm_same_file(factory, tmp):
     fs.set_base(base)
     fs.rm("foo")
     # Do something else besides, so commit has different sha1
-    fs.open("baz", "wb").write(b"Prego\n")
+    write_file(fs, "baz", b"Prego\n")
     transaction.commit()
 
     assert not fs.exists("foo")
     assert fs.exists("bar")
 
 
+@pytest.mark.slow
 def test_merge_add_same_file(factory):
     fs = factory(head="master")
-    fs.open("foo", "wb").write(b"Hello\n")
+    write_file(fs, "foo", b"Hello\n")
     transaction.commit()
 
     base = fs.get_base()
-    fs.open("bar", "wb").write(b"Grazie\n")
+    write_file(fs, "bar", b"Grazie\n")
     transaction.commit()
 
     fs.set_base(base)
-    fs.open("bar", "wb").write(b"Grazie\n")
+    write_file(fs, "bar", b"Grazie\n")
     # Do something else besides, so commit has different sha1
-    fs.open("baz", "wb").write(b"Prego\n")
+    write_file(fs, "baz", b"Prego\n")
     transaction.commit()
 
-    assert fs.open("bar", "rb").read() == b"Grazie\n"
-    assert fs.open("baz", "rb").read() == b"Prego\n"
+    assert read_file(fs, "bar") == b"Grazie\n"
+    assert read_file(fs, "baz") == b"Prego\n"
 
 
+@pytest.mark.slow
 def test_merge_add_different_file_same_path(factory):
-    from acidfs import ConflictError
-
     fs = factory(head="master")
-    fs.open("foo", "wb").write(b"Hello\n")
+    write_file(fs, "foo", b"Hello\n")
     transaction.commit()
 
     base = fs.get_base()
-    fs.open("bar", "wb").write(b"Grazie\n")
+    write_file(fs, "bar", b"Grazie\n")
     transaction.commit()
 
     fs.set_base(base)
-    fs.open("bar", "wb").write(b"Prego\n")
+    write_file(fs, "bar", b"Prego\n")
     with pytest.raises(ConflictError):
         transaction.commit()
 
 
+@pytest.mark.slow
 def test_merge_file(factory):
     fs = factory()
     with fs.open("foo", "wb") as f:
@@ -811,7 +1338,7 @@ def test_merge_file(factory):
         fprint(f, b"Sei")
     transaction.commit()
 
-    assert list(fs.open("foo", "rb").readlines()) == [
+    assert read_file(fs, "foo").splitlines(keepends=True) == [
         b"One\n",
         b"Dos\n",
         b"Three\n",
@@ -822,14 +1349,12 @@ def test_merge_file(factory):
 
 
 def test_set_base(factory):
-    from acidfs import ConflictError
-
     fs = factory()
-    fs.open("foo", "wb").write(b"Hello\n")
+    write_file(fs, "foo", b"Hello\n")
     transaction.commit()
 
     base = fs.get_base()
-    fs.open("bar", "wb").write(b"Grazie\n")
+    write_file(fs, "bar", b"Grazie\n")
     with pytest.raises(ConflictError):
         fs.set_base("whatever")
     transaction.commit()
@@ -837,7 +1362,7 @@ def test_set_base(factory):
     fs.set_base(base)
     assert fs.exists("foo")
     assert not fs.exists("bar")
-    fs.open("baz", "wb").write(b"Prego\n")
+    write_file(fs, "baz", b"Prego\n")
     transaction.commit()
 
     assert fs.exists("foo")
@@ -845,32 +1370,228 @@ def test_set_base(factory):
     assert fs.exists("baz")
 
 
-def test_use_other_branch(factory):
+def test_lock_excludes_other_threads(factory, tmp):
+    session = factory()._session()
+    other = AcidFS(tmp)._session()
+    session.acquire_lock()
+
+    acquired = threading.Event()
+
+    def vote():
+        other.acquire_lock()
+        acquired.set()
+        other.release_lock()
+
+    thread = threading.Thread(target=vote)
+    thread.start()
+    assert not acquired.wait(0.1)
+    session.release_lock()
+    thread.join()
+    assert acquired.is_set()
+
+
+def test_use_other_branch(factory, tmp):
     fs = factory(head="foo")
-    fs.open("foo", "wb").write(b"Hello\n")
+    write_file(fs, "foo", b"Hello\n")
     transaction.commit()
 
     fs2 = factory()
-    fs2.open("foo", "wb").write(b"Howdy!\n")
+    write_file(fs2, "foo", b"Howdy!\n")
+    transaction.commit()
+
+    assert read_file(fs, "foo") == b"Hello\n"
+    assert read_file(fs2, "foo") == b"Howdy!\n"
+
+    # Committing again to the other branch builds on that branch, not HEAD
+    write_file(fs, "bar", b"Ciao\n")
+    transaction.commit()
+    assert read_file(fs, "foo") == b"Hello\n"
+    assert not fs2.exists("bar")
+    assert (
+        _check_output(["git", "rev-list", "--count", "refs/heads/foo"], cwd=tmp)
+        == b"2\n"
+    )
+
+
+def test_detached_head(factory, tmp):
+    fs = factory()
+    write_file(fs, "foo", b"Hello\n")
+    transaction.commit()
+
+    git(tmp, "checkout", "-q", "--detach", "HEAD")
+    with pytest.raises(ValueError):
+        fs.open("foo", "rb")
+
+    fs = factory(head="master")
+    assert read_file(fs, "foo") == b"Hello\n"
+
+
+def test_packed_refs(factory, tmp):
+    fs = factory()
+    write_file(fs, "foo", b"Hello\n")
+    transaction.commit()
+    base = fs.get_base()
+
+    git(tmp, "pack-refs", "--all")
+    assert not os.path.exists(os.path.join(tmp, ".git", "refs", "heads", "master"))
+    assert fs.get_base() == base
+    assert read_file(fs, "foo") == b"Hello\n"
+    write_file(fs, "foo", b"Howdy!\n")
+    transaction.commit()
+    assert count_commits(tmp) == 2
+
+
+def test_nested_branch_name(factory, tmp):
+    fs = factory(head="a/b")
+    write_file(fs, "foo", b"Hello\n")
+    transaction.commit()
+    assert os.listdir(os.path.join(tmp, ".git", "refs", "heads", "a")) == ["b"]
+    assert _check_output(["git", "show", "a/b:foo"], cwd=tmp) == b"Hello\n"
+
+
+def test_branch_locked_by_git(factory, tmp):
+    fs = factory(head="foo")
+    write_file(fs, "foo", b"Hello\n")
+    transaction.commit()
+
+    # git holds the lock on the ref
+    lockfile = pathlib.Path(tmp, ".git", "refs", "heads", "foo.lock")
+    lockfile.touch()
+    write_file(fs, "foo", b"Howdy!\n")
+    with pytest.raises(ConflictError):
+        transaction.commit()
+    transaction.abort()
+    assert lockfile.exists()
+    lockfile.unlink()
+
+    # Our own lock is let go if the transaction doesn't finish
+    write_file(fs, "foo", b"Howdy!\n")
+    fs._session().tpc_vote(transaction.get())
+    assert lockfile.exists()
+    transaction.abort()
+    assert not lockfile.exists()
+    assert read_file(fs, "foo") == b"Hello\n"
+
+
+def test_branch_conflicts_with_other_branch(factory, tmp):
+    fs = factory(head="a/b")
+    write_file(fs, "foo", b"Hello\n")
+    transaction.commit()
+
+    heads = os.path.join(tmp, ".git", "refs", "heads")
+
+    def assert_conflict(head, other):
+        fs = factory(head=head)
+        write_file(fs, "foo", b"Howdy!\n")
+        with pytest.raises(ConflictError) as cm:
+            transaction.commit()
+        expected = "Cannot update refs/heads/%s, since %s exists." % (head, other)
+        assert str(cm.value) == expected
+        transaction.abort()
+
+    assert_conflict("a", "refs/heads/a/...")
+    assert_conflict("a/b/c", "refs/heads/a/b")
+    assert os.listdir(heads) == ["a"]
+    assert os.listdir(os.path.join(heads, "a")) == ["b"]
+
+    # Same goes for packed refs
+    git(tmp, "pack-refs", "--all")
+    assert os.listdir(heads) == []
+    assert_conflict("a", "refs/heads/a/b")
+    assert_conflict("a/b/c", "refs/heads/a/b")
+    assert os.listdir(heads) == []
+
+    # Other branches are fine
+    fs = factory(head="c")
+    write_file(fs, "foo", b"Howdy!\n")
+    transaction.commit()
+    assert os.listdir(heads) == ["c"]
+
+
+def test_new_branch_not_written(factory, tmp):
+    heads = os.path.join(tmp, ".git", "refs", "heads")
+    fs = factory(head="x/y")
+    write_file(fs, "foo", b"Hello\n")
+
+    # Giving up on a new branch removes the folder made for it
+    fs._session().tpc_vote(transaction.get())
+    assert os.listdir(os.path.join(heads, "x")) == ["y.lock"]
+    transaction.abort()
+    assert not os.path.exists(os.path.join(heads, "x"))
+
+    # So does failing to move the lock file into place, unless something
+    # else has been put in the folder meanwhile
+    write_file(fs, "foo", b"Hello\n")
+    session = fs._session()
+    tx = transaction.get()
+    session.tpc_vote(tx)
+    os.mkdir(os.path.join(heads, "x", "y"))
+    with pytest.raises(OSError):
+        session.tpc_finish(tx)
+    assert session.closed
+    assert os.listdir(os.path.join(heads, "x")) == ["y"]
+    transaction.abort()
+
+    # Nothing is left locked
+    os.rmdir(os.path.join(heads, "x", "y"))
+    write_file(fs, "foo", b"Hello\n")
+    transaction.commit()
+    assert _check_output(["git", "show", "x/y:foo"], cwd=tmp) == b"Hello\n"
+
+
+def test_head_is_symbolic_ref(factory, tmp):
+    fs = factory()
+    write_file(fs, "foo", b"Hello\n")
     transaction.commit()
+    git(tmp, "symbolic-ref", "refs/heads/alias", "refs/heads/master")
 
-    assert fs.open("foo", "rb").read() == b"Hello\n"
-    assert fs2.open("foo", "rb").read() == b"Howdy!\n"
+    alias = factory(head="alias")
+    assert alias.get_base() == fs.get_base()
+    assert read_file(alias, "foo") == b"Hello\n"
 
 
-def test_branch_and_then_merge(factory, tmp):
+def test_head_is_prefix_of_other_branch(factory, tmp):
     fs = factory()
-    fs.open("foo", "wb").write(b"Hello")
+    write_file(fs, "foo", b"Hello\n")
+    transaction.commit()
+    git(tmp, "branch", "a/b")
+
+    fs = factory(head="a")
+    assert fs.get_base() is None
+    assert not fs.exists("foo")
+
+
+def test_set_base_ahead_of_head(factory, tmp):
+    fs = factory()
+    write_file(fs, "foo", b"Hello\n")
+    transaction.commit()
+
+    fs2 = factory(head="ahead")
+    fs2.set_base(fs.get_base())
+    write_file(fs2, "bar", b"Ciao\n")
+    transaction.commit()
+
+    # The head is in the history of the new base, so no merge is needed
+    fs.set_base("ahead")
+    write_file(fs, "baz", b"Hola\n")
+    transaction.commit()
+    assert fs.exists("bar")
+    assert count_commits(tmp) == 3
+
+
+def test_branch_and_then_merge(factory, catfile):
+    fs = factory()
+    write_file(fs, "foo", b"Hello")
     transaction.commit()
 
     fs2 = factory(head="abranch")
     fs2.set_base(fs.get_base())
-    fs2.open("bar", "wb").write(b"Ciao")
-    fs.open("baz", "wb").write(b"Hola")
+    write_file(fs2, "bar", b"Ciao")
+    write_file(fs, "baz", b"Hola")
     transaction.commit()
 
     fs.set_base("abranch")
-    fs.open("beez", "wb").write(b"buzz")
+    write_file(fs, "beez", b"buzz")
     transaction.commit()
 
     assert fs.exists("foo")
@@ -883,11 +1604,7 @@ def test_branch_and_then_merge(factory, tmp):
     assert not fs2.exists("beez")
 
     # Expecting two parents for commit since it's a merge
-    commit = (
-        _check_output(["git", "cat-file", "-p", "HEAD^{commit}"], cwd=tmp)
-        .decode("ascii")
-        .split("\n")
-    )
+    commit = catfile.read("HEAD^{commit}").decode("ascii").split("\n")
     assert commit[1].startswith("parent")
     assert commit[2].startswith("parent")
 
@@ -896,36 +1613,62 @@ def test_directory_name_with_spaces(factory):
     fs = factory()
     fs.mkdir("foo bar")
     with fs.cd("foo bar"):
-        fs.open("foo", "wb").write(b"bar")
+        write_file(fs, "foo", b"bar")
     transaction.commit()
 
     with fs.cd("foo bar"):
-        assert fs.open("foo", "rb").read() == b"bar"
+        assert read_file(fs, "foo") == b"bar"
 
 
-@mock.patch("acidfs.subprocess.Popen")
-def test_called_process_error(Popen):
-    from acidfs import _popen
+def test_mkpath(fs):
+    fs.mkdirs("one/a")
+    assert fs._mkpath(".") == ()
+    assert fs._mkpath("//one//a/") == ("one", "a")
+    fs.chdir("one")
+    assert fs._mkpath("a") == ("one", "a")
+    assert fs._mkpath("/a") == ("a",)
 
-    Popen.return_value.return_value.wait.return_value = 1
-    with pytest.raises(subprocess.CalledProcessError):
-        with _popen(["what", "ever"]):
+
+def test_popen_drains_output():
+    args = ["sh", "-c", "head -c 200000 /dev/zero; head -c 200000 /dev/zero >&2"]
+    with _popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+        assert proc.stdout.read(10) == b"\0" * 10
+
+
+def test_popen_stdin_closed_early():
+    with _popen(["cat"], stdin=subprocess.PIPE, stdout=subprocess.PIPE) as proc:
+        proc.stdin.write(b"Hello!\n")
+        proc.stdin.close()
+        assert proc.stdout.read() == b"Hello!\n"
+
+
+def test_called_process_error():
+    with pytest.raises(subprocess.CalledProcessError) as cm:
+        with _popen(["sh", "-c", "exit 3"]):
             pass
+    assert cm.value.returncode == 3
+
+
+def read_file(fs, path):
+    with fs.open(path, "rb") as f:
+        return f.read()
+
+
+def write_file(fs, path, data):
+    with fs.open(path, "wb") as f:
+        f.write(data)
 
 
 def fprint(f, s):
-    f.write(s)
     if isinstance(f, io.TextIOWrapper):
-        f.write(u"\n")
+        f.write(s + "\n")
     else:
-        f.write(b"\n")
+        f.write(s + b"\n")
 
 
-def count_commits(tmp):
-    output = _check_output(["git", "log"], cwd=tmp)
-    commits = 0
-    for line in output.split(b"\n"):
-        if line.startswith(b"commit "):
-            commits += 1
+def git(repo, *args):
+    subprocess.check_call(("git",) + args, cwd=repo, stdout=subprocess.DEVNULL)
 
-    return commits
+
+def count_commits(tmp):
+    return int(_check_output(["git", "rev-list", "--count", "HEAD"], cwd=tmp))